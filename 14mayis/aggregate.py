@@ -0,0 +1,169 @@
+import argparse
+import os
+from glob import glob
+
+import numpy as np
+
+from candidates import VOTE_KEYS
+from compact import RESULT_KINDS, build_hierarchy, file_id
+from files import atomic_write, read_json
+
+AGGREGATES_FILENAME = 'aggregates.npz'
+
+# From the top of the hierarchy down, every level's parent is the one before it
+LEVELS = ('city', 'district', 'neighborhood', 'school')
+PARENT_COLUMNS = {'district': 'city_id', 'neighborhood': 'district_id', 'school': 'neighborhood_id'}
+HIERARCHY_TABLES = {'city': 'cities', 'district': 'districts', 'neighborhood': 'neighborhoods', 'school': 'schools'}
+
+# Candidates (cm) and parties (mv) on the ballots, numbered from 1 in the API's votes
+VOTE_COUNTS = {'cm': 4, 'mv': 24}
+
+# One int32 row of counts per city, district, neighborhood and school, the national totals stay far
+# below its limit. Boxes without a result of a kind are ballot_boxes minus {kind}_boxes.
+COLUMNS = ['ballot_boxes']
+for kind in RESULT_KINDS:
+    COLUMNS += [f'{kind}_boxes', f'{kind}_total_vote']
+    COLUMNS += [f'{kind}_votes_{candidate_id}' for candidate_id in range(1, VOTE_COUNTS[kind] + 1)]
+COLUMN_INDEX = {column: index for index, column in enumerate(COLUMNS)}
+
+
+def school_counts(ballot_boxes_in_school_data):
+    counts = np.zeros(len(COLUMNS), dtype=np.int32)
+    counts[COLUMN_INDEX['ballot_boxes']] = len(ballot_boxes_in_school_data)
+    for ballot_box in ballot_boxes_in_school_data:
+        for kind in RESULT_KINDS:
+            result = ballot_box.get(f'{kind}_result')
+            if not result:
+                continue
+            counts[COLUMN_INDEX[f'{kind}_boxes']] += 1
+            counts[COLUMN_INDEX[f'{kind}_total_vote']] += result.get('total_vote') or 0
+            # Candidates without votes are left out of the API response
+            for candidate_id, votes in result.get('votes', {}).items():
+                counts[COLUMN_INDEX[f'{kind}_votes_{candidate_id}']] += votes or 0
+    return counts
+
+
+class Aggregates:
+    # Per level: the ids, the row of each one's parent in the level above and a counts matrix with
+    # one row per id. Every row is the sum of its children, so changing one school only touches
+    # the rows on its path to the city.
+    def __init__(self, ids, parents, counts):
+        self.ids = ids
+        self.parents = parents
+        self.counts = counts
+        self.rows = {level: {int(entity_id): row for row, entity_id in enumerate(ids[level])} for level in LEVELS}
+
+    @classmethod
+    def build(cls, root='.'):
+        tables = build_hierarchy(root)
+        ids = {level: np.array(tables[HIERARCHY_TABLES[level]].column('id').to_pylist(), dtype=np.int32)
+               for level in LEVELS}
+
+        parents = {}
+        for parent_level, level in zip(LEVELS, LEVELS[1:]):
+            parent_rows = {int(entity_id): row for row, entity_id in enumerate(ids[parent_level])}
+            parent_ids = tables[HIERARCHY_TABLES[level]].column(PARENT_COLUMNS[level]).to_pylist()
+            parents[level] = np.array([parent_rows[parent_id] for parent_id in parent_ids], dtype=np.int32)
+
+        counts = {level: np.zeros((len(ids[level]), len(COLUMNS)), dtype=np.int32) for level in LEVELS}
+        aggregates = cls(ids, parents, counts)
+
+        unknown = 0
+        school_rows = aggregates.rows['school']
+        for filename in glob(os.path.join(root, 'ballot_boxes_in_school', '*.json')):
+            row = school_rows.get(file_id(filename))
+            if row is None:
+                unknown += 1
+                continue
+            counts['school'][row] = school_counts(read_json(filename))
+        if unknown:
+            print(f'Skipped {unknown} ballot box files of schools missing from the schools tree')
+
+        aggregates.roll_up()
+        return aggregates
+
+    def roll_up(self):
+        # Recompute every level above the schools from the level below it
+        for parent_level, level in reversed(list(zip(LEVELS, LEVELS[1:]))):
+            self.counts[parent_level][:] = 0
+            np.add.at(self.counts[parent_level], self.parents[level], self.counts[level])
+
+    def update_school(self, school_id, ballot_boxes_in_school_data):
+        # Apply the difference to the school and its ancestors, returns False when nothing changed
+        row = self.rows['school'].get(school_id)
+        if row is None:
+            raise KeyError(f'School {school_id} is not in the schools tree')
+        delta = school_counts(ballot_boxes_in_school_data) - self.counts['school'][row]
+        if not delta.any():
+            return False
+
+        for level in reversed(LEVELS):
+            self.counts[level][row] += delta
+            if level != LEVELS[0]:
+                row = self.parents[level][row]
+        return True
+
+    def update_file(self, filename):
+        return self.update_school(file_id(filename), read_json(filename))
+
+    def totals(self, level, entity_id):
+        counts = self.counts[level][self.rows[level][entity_id]]
+        return dict(zip(COLUMNS, counts.tolist()))
+
+    def save(self, filename=AGGREGATES_FILENAME):
+        arrays = {'columns': np.array(COLUMNS)}
+        for level in LEVELS:
+            arrays[f'{level}_ids'] = self.ids[level]
+            arrays[f'{level}_counts'] = self.counts[level]
+            if level in self.parents:
+                arrays[f'{level}_parents'] = self.parents[level]
+
+        # Saved uncompressed so loading is a plain read, then renamed into place
+        with atomic_write(filename) as outfile:
+            np.savez(outfile, **arrays)
+
+    @classmethod
+    def load(cls, filename=AGGREGATES_FILENAME):
+        with np.load(filename) as arrays:
+            if arrays['columns'].tolist() != COLUMNS:
+                raise ValueError(f'{filename} was saved with other columns, rebuild it')
+            ids = {level: arrays[f'{level}_ids'] for level in LEVELS}
+            counts = {level: arrays[f'{level}_counts'] for level in LEVELS}
+            parents = {level: arrays[f'{level}_parents'] for level in LEVELS[1:]}
+        return cls(ids, parents, counts)
+
+
+def print_totals(aggregates, level, entity_id):
+    totals = aggregates.totals(level, entity_id)
+    print(f'{level} {entity_id}: {totals["ballot_boxes"]} ballot boxes, {totals["cm_boxes"]} with a cm result, '
+          f'{totals["cm_total_vote"]} votes')
+    for vote_key, candidate in VOTE_KEYS.items():
+        votes = totals[f'cm_votes_{vote_key}']
+        share = votes / totals['cm_total_vote'] * 100 if totals['cm_total_vote'] else 0.0
+        print(f'  {candidate}: {votes} ({share:.2f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Roll the ballot box votes up to neighborhoods, districts and cities.')
+    parser.add_argument('--root', default='.', help='Directory holding the scraped JSON tree')
+    parser.add_argument('--output', default=AGGREGATES_FILENAME)
+    parser.add_argument('--update', nargs='+', metavar='FILE',
+                        help='Apply changed ballot_boxes_in_school files to the saved aggregates instead of rebuilding')
+    parser.add_argument('--show', nargs=2, metavar=('LEVEL', 'ID'), help='Print the totals of one city, district, ...')
+    args = parser.parse_args()
+
+    if args.update:
+        aggregates = Aggregates.load(args.output)
+        changed = sum(aggregates.update_file(filename) for filename in args.update)
+        print(f'Updated {changed} of {len(args.update)} schools')
+    else:
+        aggregates = Aggregates.build(args.root)
+        print(f'Aggregated {len(aggregates.ids["school"])} schools into {len(aggregates.ids["city"])} cities')
+    aggregates.save(args.output)
+
+    if args.show:
+        print_totals(aggregates, args.show[0], int(args.show[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+from PIL import Image
+
+from candidates import VOTE_KEYS
+from compact import DATASET_DIR, build_ballot_boxes, build_hierarchy, load_table
+from files import atomic_write
+from images import IMAGES_DIR
+from reconcile import load_image_hashes, reconcile
+from work_queue import REVIEW, WorkQueue
+
+ANOMALIES_FILENAME = 'anomalies.csv'
+CHECKS = ('totals', 'shares', 'duplicates', 'ocr')
+
+# A ballot box serves at most 350 registered voters, the margin covers the staff voting there
+MAX_BOX_VOTERS = 450
+# Both ballots are cast by the same voters, only blank and invalid votes make their totals differ
+MAX_TOTALS_GAP = 20
+MAX_TOTALS_GAP_SHARE = 0.2
+
+# A box's candidate share is compared with the other boxes of its school, neighborhood and district
+SHARE_LEVELS = ('school', 'neighborhood', 'district')
+MIN_NEIGHBOURS = 4
+SHARE_Z_THRESHOLD = 4.0
+MAX_SHARE_SCORE = 3.0
+# Floor of the standard deviation, so a group of near identical boxes does not flag small differences
+MIN_SHARE_STD = 0.02
+
+# dHash of 8x8 gradients, sheets at most DUPLICATE_DISTANCE bits apart are taken as the same photo.
+# Split into one more band than the distance, two such hashes share at least one band exactly.
+DHASH_FILENAME = 'dhash.npz'
+DUPLICATE_DISTANCE = 3
+HASH_BANDS = DUPLICATE_DISTANCE + 1
+# Larger buckets are hashes of blank or uniform images, not of photographed sheets
+MAX_BUCKET = 64
+
+# Votes of difference from the API that make a full OCR mismatch score
+OCR_SCORE_SCALE = 20
+
+# Every check scores a flagged box from about 1 up, a definite error weighs more than a statistical one
+TOTALS_WEIGHT = 3.0
+DUPLICATE_WEIGHT = 2.0
+
+
+def load_boxes(root='.', dataset_dir=DATASET_DIR):
+    # The cm results of every ballot box as arrays, from the dataset of compact.py when there is one
+    if os.path.exists(os.path.join(dataset_dir, 'ballot_boxes.arrow')) or \
+            os.path.exists(os.path.join(dataset_dir, 'ballot_boxes.parquet')):
+        table = load_table('ballot_boxes', dataset_dir)
+        schools = load_table('schools', dataset_dir)
+    else:
+        table = build_ballot_boxes(root)
+        schools = build_hierarchy(root)['schools']
+
+    def column(name, fill=0):
+        if name not in table.column_names:
+            return np.full(table.num_rows, fill, dtype=np.int64)
+        return table.column(name).fill_null(fill).to_numpy().astype(np.int64)
+
+    boxes = {
+        'school_id': column('school_id'),
+        'ballot_box_number': column('ballot_box_number'),
+        'has_cm': table.column('cm_total_vote').is_valid().to_numpy(zero_copy_only=False),
+        'has_mv': table.column('mv_total_vote').is_valid().to_numpy(zero_copy_only=False),
+        'total': column('cm_total_vote'),
+        'mv_total': column('mv_total_vote'),
+        # Candidates without votes in any box have no column, they got no votes
+        'votes': np.stack([column(f'cm_votes_{vote_key}') for vote_key in VOTE_KEYS], axis=1),
+        'image_url': table.column('cm_image_url').to_pylist(),
+    }
+
+    # Parents of every box's school, -1 for schools missing from the hierarchy
+    school_ids = schools.column('id').to_numpy()
+    order = np.argsort(school_ids)
+    positions = np.clip(np.searchsorted(school_ids, boxes['school_id'], sorter=order), 0, len(order) - 1)
+    rows = order[positions]
+    known = school_ids[rows] == boxes['school_id']
+    for level in ('city', 'district', 'neighborhood'):
+        parent_ids = schools.column(f'{level}_id').to_numpy().astype(np.int64)
+        boxes[f'{level}_id'] = np.where(known, parent_ids[rows], -1)
+    return boxes
+
+
+def check_totals(boxes):
+    # Results that cannot be right whatever was written on the sheet
+    has_cm = boxes['has_cm']
+    total = boxes['total']
+    candidate_sum = boxes['votes'].sum(axis=1)
+    gap = np.abs(total - boxes['mv_total'])
+
+    reasons = [
+        (has_cm & (candidate_sum != total), 'candidates add up to {sum}, total_vote is {total}',
+         np.abs(candidate_sum - total) / np.maximum(total, 1)),
+        (has_cm & (total > MAX_BOX_VOTERS), 'total_vote {total} above the {max_voters} voters of a box',
+         (total - MAX_BOX_VOTERS) / MAX_BOX_VOTERS),
+        (has_cm & boxes['has_mv'] & (gap > np.maximum(MAX_TOTALS_GAP, MAX_TOTALS_GAP_SHARE * total)),
+         'cm total {total} and mv total {mv_total} differ', gap / np.maximum(total, 1)),
+    ]
+    flags = []
+    for flagged, template, severity in reasons:
+        for index in np.flatnonzero(flagged):
+            detail = template.format(sum=candidate_sum[index], total=total[index], mv_total=boxes['mv_total'][index],
+                                     max_voters=MAX_BOX_VOTERS)
+            flags.append((index, 'totals', TOTALS_WEIGHT + min(float(severity[index]), 1.0), detail))
+    return flags
+
+
+def leave_one_out_z(shares, groups):
+    # z-score of every row's shares against the other rows of its group, 0 where there are too few
+    group = np.unique(groups, return_inverse=True)[1]
+    others = np.bincount(group)[group][:, None] - 1
+    sums = np.stack([np.bincount(group, weights=shares[:, column]) for column in range(shares.shape[1])], axis=1)
+    squares = np.stack([np.bincount(group, weights=shares[:, column] ** 2) for column in range(shares.shape[1])],
+                       axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (sums[group] - shares) / others
+        variance = (squares[group] - shares ** 2) / others - mean ** 2
+    std = np.maximum(np.sqrt(np.clip(np.nan_to_num(variance), 0, None)), MIN_SHARE_STD)
+    z = np.where(others >= MIN_NEIGHBOURS, (shares - np.nan_to_num(mean)) / std, 0.0)
+    return z, np.nan_to_num(mean)
+
+
+def check_shares(boxes):
+    # Candidate shares far from the other boxes of the same school, neighborhood or district
+    valid = np.flatnonzero(boxes['has_cm'] & (boxes['total'] > 0))
+    shares = boxes['votes'][valid] / boxes['total'][valid, None]
+    candidates = list(VOTE_KEYS.values())
+
+    best_z = np.zeros(len(valid))
+    best = {}
+    for level in SHARE_LEVELS:
+        groups = boxes[f'{level}_id'][valid]
+        z, mean = leave_one_out_z(shares, groups)
+        # Boxes of schools missing from the hierarchy are only compared within their school
+        z[groups < 0] = 0
+        candidate = np.abs(z).argmax(axis=1)
+        level_z = np.abs(z)[np.arange(len(valid)), candidate]
+        better = level_z > best_z
+        best_z = np.where(better, level_z, best_z)
+        for position in np.flatnonzero(better & (level_z >= SHARE_Z_THRESHOLD)):
+            best[position] = (level, candidate[position], mean[position, candidate[position]],
+                              z[position, candidate[position]])
+
+    flags = []
+    for position, (level, candidate, mean, z) in best.items():
+        index = valid[position]
+        detail = (f'{candidates[candidate]} has {shares[position, candidate]:.1%}, '
+                  f'{mean:.1%} in the rest of the {level} (z={z:+.1f})')
+        flags.append((index, 'shares', min(float(best_z[position]) / SHARE_Z_THRESHOLD, MAX_SHARE_SCORE), detail))
+    return flags
+
+
+def dhash(filename):
+    # 64 bit difference hash of the sheet, robust to recompression and resizing
+    with Image.open(filename) as image:
+        # Let the JPEG decoder scale down while decoding, a full decode is most of the time otherwise
+        image.draft('L', (64, 64))
+        pixels = np.asarray(image.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def dhash_file(filename):
+    try:
+        return dhash(filename)
+    except (OSError, ValueError):
+        return None
+
+
+def image_dhashes(images_root=IMAGES_DIR, workers=None):
+    # SHA-256 -> dHash of every image in the store, only images new since the last run are decoded
+    filename = os.path.join(images_root, DHASH_FILENAME)
+    hashes = {}
+    if os.path.exists(filename):
+        with np.load(filename) as arrays:
+            hashes = dict(zip(arrays['digests'].tolist(), arrays['hashes'].tolist()))
+
+    paths = {os.path.splitext(os.path.basename(path))[0]: path
+             for path in glob(os.path.join(images_root, 'sha256', '*', '*.jpg'))}
+    new_digests = [digest for digest in paths if digest not in hashes]
+    if new_digests:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for digest, image_hash in zip(new_digests, executor.map(
+                    dhash_file, [paths[digest] for digest in new_digests], chunksize=64)):
+                if image_hash is not None:
+                    hashes[digest] = image_hash
+
+        with atomic_write(filename) as outfile:
+            np.savez(outfile, digests=np.array(list(hashes), dtype='U64'),
+                     hashes=np.array(list(hashes.values()), dtype=np.uint64))
+    return hashes
+
+
+def hamming(left, right):
+    return np.unpackbits((left ^ right).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def near_duplicates(hashes):
+    # Index pairs of hashes at most DUPLICATE_DISTANCE bits apart, found through their identical bands
+    band_bits = 64 // HASH_BANDS
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    for band in range(HASH_BANDS):
+        keys = (hashes >> np.uint64(band * band_bits)) & np.uint64((1 << band_bits) - 1)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        sizes = np.diff(np.r_[starts, len(keys)])
+        # Most shared buckets are chance collisions of two hashes, those are paired in one go
+        two = starts[sizes == 2]
+        pairs.append(np.stack([order[two], order[two + 1]], axis=1))
+        larger = (sizes > 2) & (sizes <= MAX_BUCKET)
+        for start, size in zip(starts[larger], sizes[larger]):
+            members = order[start:start + size]
+            left, right = np.triu_indices(size, 1)
+            pairs.append(np.stack([members[left], members[right]], axis=1))
+    pairs = np.unique(np.sort(np.concatenate(pairs), axis=1), axis=0)
+    distances = hamming(hashes[pairs[:, 0]], hashes[pairs[:, 1]])
+    close = distances <= DUPLICATE_DISTANCE
+    return pairs[close], distances[close]
+
+
+def check_duplicates(boxes, root='.', workers=None):
+    # The same sheet photo on more than one ballot box, byte for byte or recompressed
+    url_digests = load_image_hashes(root)
+    box_digests = np.array([url_digests.get(image_url) or '' if image_url else '' for image_url in boxes['image_url']])
+    boxes_of = {}
+    for index in np.flatnonzero(box_digests != ''):
+        boxes_of.setdefault(box_digests[index], []).append(index)
+
+    matches = {}
+
+    def match(indices, others, distance):
+        for index in indices:
+            for other in others:
+                if other != index and distance < matches.get(index, (None, DUPLICATE_DISTANCE + 1))[1]:
+                    matches[index] = (other, distance)
+
+    # Larger groups of boxes with the very same file share a placeholder, not a photographed sheet
+    boxes_of = {digest: indices for digest, indices in boxes_of.items() if len(indices) <= MAX_BUCKET}
+    for indices in boxes_of.values():
+        match(indices, indices, 0)
+
+    hashes = image_dhashes(os.path.join(root, IMAGES_DIR), workers)
+    digests = [digest for digest in boxes_of if digest in hashes]
+    pairs, distances = near_duplicates(np.array([hashes[digest] for digest in digests], dtype=np.uint64))
+    for (left, right), distance in zip(pairs.tolist(), distances.tolist()):
+        match(boxes_of[digests[left]], boxes_of[digests[right]], distance)
+        match(boxes_of[digests[right]], boxes_of[digests[left]], distance)
+
+    flags = []
+    for index, (other, distance) in matches.items():
+        detail = (f'same sheet as school {boxes["school_id"][other]} box {boxes["ballot_box_number"][other]} '
+                  f'({distance} bits apart)')
+        flags.append((index, 'duplicates', DUPLICATE_WEIGHT - distance / (DUPLICATE_DISTANCE + 1), detail))
+    return flags
+
+
+def check_ocr(boxes, root='.', workers=None):
+    # The tutanak read by OCR and the submitted votes disagree, reconcile.py's comparison
+    rows, missing = reconcile(root, workers)
+    box_index = {(school_id, ballot_box_number): index for index, (school_id, ballot_box_number)
+                 in enumerate(zip(boxes['school_id'].tolist(), boxes['ballot_box_number'].tolist()))}
+    flags = []
+    for row in rows:
+        index = box_index.get((row['school_id'], row['ballot_box_number']))
+        # Sheets OCR could not read at all say nothing about the submission
+        if index is None or row['score'] == 0 or row['unread'] == len(VOTE_KEYS):
+            continue
+        # A sheet that adds up to its own total was read right, the submission differs from it
+        score = (1.0 if row['ocr_consistent'] else 0.5) + min(row['score'] / OCR_SCORE_SCALE, 1.0)
+        detail = f'OCR differs from the API by {row["score"]} votes' + \
+                 ('' if row['ocr_consistent'] else ', the sheet does not add up either')
+        flags.append((index, 'ocr', score, detail))
+    return flags
+
+
+def rank(boxes, flags):
+    # One row per flagged box, the scores of its checks summed
+    rows = {}
+    for index, check, score, detail in flags:
+        row = rows.get(index)
+        if row is None:
+            row = rows[index] = {
+                'score': 0.0,
+                'checks': [],
+                'details': [],
+                'school_id': int(boxes['school_id'][index]),
+                'ballot_box_number': int(boxes['ballot_box_number'][index]),
+                'city_id': int(boxes['city_id'][index]),
+                'district_id': int(boxes['district_id'][index]),
+                'neighborhood_id': int(boxes['neighborhood_id'][index]),
+                'total_vote': int(boxes['total'][index]),
+                'image_url': boxes['image_url'][index],
+            }
+        row['score'] += score
+        row['checks'].append(check)
+        row['details'].append(detail)
+    ranked = sorted(rows.values(), key=lambda row: -row['score'])
+    for row in ranked:
+        row['score'] = round(row['score'], 3)
+        row['checks'] = ';'.join(row['checks'])
+        row['details'] = '; '.join(row['details'])
+    return ranked
+
+
+def write_report(rows, filename=ANOMALIES_FILENAME):
+    fieldnames = ['score', 'checks', 'school_id', 'ballot_box_number', 'city_id', 'district_id', 'neighborhood_id',
+                  'total_vote', 'details', 'image_url']
+    with open(filename, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flag suspicious ballot box results across the whole corpus.')
+    parser.add_argument('--root', default='.', help='Directory holding ballot_boxes_in_school, images and OCR data')
+    parser.add_argument('--dataset', default=DATASET_DIR,
+                        help='Read the ballot boxes from the dataset of compact.py when it exists')
+    parser.add_argument('--checks', nargs='+', choices=CHECKS, default=list(CHECKS))
+    parser.add_argument('--workers', type=int, help='Worker processes for hashing and OCR, all CPU cores by default')
+    parser.add_argument('--output', default=ANOMALIES_FILENAME)
+    parser.add_argument('--queue', help='Also push the flagged boxes to this work queue for review')
+    args = parser.parse_args()
+
+    started_at = time.monotonic()
+    boxes = load_boxes(args.root, os.path.join(args.root, args.dataset))
+    print(f'Loaded {len(boxes["school_id"])} ballot boxes in {time.monotonic() - started_at:.1f}s')
+
+    flags = []
+    for check in args.checks:
+        check_started_at = time.monotonic()
+        if check == 'totals':
+            check_flags = check_totals(boxes)
+        elif check == 'shares':
+            check_flags = check_shares(boxes)
+        elif check == 'duplicates':
+            check_flags = check_duplicates(boxes, args.root, args.workers)
+        else:
+            check_flags = check_ocr(boxes, args.root, args.workers)
+        print(f'{check}: {len(check_flags)} ballot boxes flagged in {time.monotonic() - check_started_at:.1f}s')
+        flags.extend(check_flags)
+
+    rows = rank(boxes, flags)
+    write_report(rows, args.output)
+    if args.queue:
+        queue = WorkQueue(args.queue)
+        queue.push(REVIEW, [(f'{row["school_id"]}/{row["ballot_box_number"]}', row['score'], row) for row in rows])
+        queue.close()
+    print(f'Saved {len(rows)} ballot boxes to review to {args.output} in {time.monotonic() - started_at:.1f}s')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from glob import glob
+
+import aiohttp
+import numpy as np
+import requests
+from PIL import Image
+
+from candidates import get_vote_counts
+from crawler import LEVELS, Crawler
+from files import read_json
+from ocr import FakeProvider, OcrStats, run_ocr, saved_textract_responses
+from preprocess import JPEG_QUALITY, preprocess_image
+from rate_limiter import AdaptiveRateLimiter
+from textract_tables import extract_tables
+
+MIRROR_PORT = 8790
+
+# The directories each crawl level reads from disk before fetching its own level
+LEVEL_INPUTS = {
+    'districts': [],
+    'neighborhoods': ['districts'],
+    'schools': ['districts', 'neighborhoods'],
+    'ballot_boxes': ['districts', 'neighborhoods', 'schools'],
+}
+
+# A stage whose throughput drops by more than this share against the baseline is reported
+REGRESSION_THRESHOLD = 0.1
+
+
+class RequestTimer:
+    # Times every request of an aiohttp session and counts statuses and response bytes
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.bytes = 0
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_request_start.append(self.on_request_start)
+        self.trace_config.on_request_end.append(self.on_request_end)
+        self.trace_config.on_request_exception.append(self.on_request_exception)
+        self.trace_config.on_response_chunk_received.append(self.on_response_chunk_received)
+
+    async def on_request_start(self, session, context, params):
+        context.started_at = time.monotonic()
+
+    async def on_request_end(self, session, context, params):
+        self.latencies.append(time.monotonic() - context.started_at)
+        self.statuses[params.response.status] += 1
+
+    async def on_request_exception(self, session, context, params):
+        self.latencies.append(time.monotonic() - context.started_at)
+        self.statuses[type(params.exception).__name__] += 1
+
+    async def on_response_chunk_received(self, session, context, params):
+        self.bytes += len(params.chunk)
+
+
+class LatencyStats(OcrStats):
+    # OcrStats that also keeps the duration of every call
+    def __init__(self):
+        super().__init__()
+        self.latencies = []
+
+    def record(self, provider, image_bytes, seconds, error=None):
+        super().record(provider, image_bytes, seconds, error)
+        with self.lock:
+            self.latencies.append(seconds)
+
+
+def stage_result(name, wall, latencies, data_bytes=0, **extra):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    result = {
+        'stage': name,
+        'wall': wall,
+        'count': len(latencies),
+        'rate': len(latencies) / wall if wall else 0.0,
+        'p50_ms': float(np.percentile(latencies, 50) * 1000) if len(latencies) else None,
+        'p99_ms': float(np.percentile(latencies, 99) * 1000) if len(latencies) else None,
+        'bytes': data_bytes,
+    }
+    result.update(extra)
+    return result
+
+
+@contextlib.contextmanager
+def mirror_server(root, port, latency, error_rate):
+    # The mirror runs in its own process so serving does not compete with the crawler's event loop
+    mirror_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mirror.py')
+    process = subprocess.Popen(
+        [sys.executable, mirror_path, '--root', root, '--port', str(port), '--no-aggregates',
+         '--latency', str(latency), '--error-rate', str(error_rate)],
+        stdout=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}/api/v1'
+    try:
+        deadline = time.monotonic() + 300
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError('The mirror exited before serving')
+            try:
+                requests.get(f'{base_url}/cities', timeout=1)
+                break
+            except requests.RequestException:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+        yield base_url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def bench_crawl(level, root, city_ids, base_url, concurrency, rate, max_rate):
+    # Fetch one level into an empty tree that links the saved levels above it, like each scraper script
+    with tempfile.TemporaryDirectory() as crawl_root:
+        cities_data = [city_item for city_item in read_json(os.path.join(root, 'cities.json'))
+                       if city_ids is None or city_item['id'] in city_ids]
+        with open(os.path.join(crawl_root, 'cities.json'), 'w') as outfile:
+            json.dump(cities_data, outfile)
+        for directory in LEVEL_INPUTS[level]:
+            os.symlink(os.path.abspath(os.path.join(root, directory)), os.path.join(crawl_root, directory))
+
+        timer = RequestTimer()
+        crawler = Crawler(levels=[level], concurrency=concurrency, base_url=base_url, root=crawl_root,
+                          limiter=AdaptiveRateLimiter(rate=rate, max_rate=max_rate),
+                          trace_configs=[timer.trace_config])
+        started_at = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(crawler.run())
+        wall = time.monotonic() - started_at
+
+    statuses = {str(status): count for status, count in sorted(timer.statuses.items(), key=str)}
+    return stage_result(f'crawl {level}', wall, timer.latencies, timer.bytes, statuses=statuses)
+
+
+def sample_images(root):
+    # The tutanak photos kept next to the saved Textract responses
+    return sorted(glob(os.path.join(root, 'images', '*', 'cm.jpg')) +
+                  glob(os.path.join(root, 'not_same', '*', 'cm.jpg')))
+
+
+def bench_preprocess(image_paths):
+    latencies = []
+    source_bytes = output_bytes = 0
+    started_at = time.monotonic()
+    for image_path in image_paths:
+        image_started_at = time.monotonic()
+        output = io.BytesIO()
+        with Image.open(image_path) as image:
+            preprocess_image(image).save(output, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+        latencies.append(time.monotonic() - image_started_at)
+        source_bytes += os.path.getsize(image_path)
+        output_bytes += output.tell()
+    return stage_result('textract preprocess', time.monotonic() - started_at, latencies, output_bytes,
+                        source_bytes=source_bytes)
+
+
+def bench_textract(root, image_paths, jobs_count, latency, workers):
+    # textract.py's OCR and parsing stages, with the fake provider replaying the saved responses
+    provider = FakeProvider(saved_textract_responses(root), latency)
+    stats = LatencyStats()
+    jobs = [(index, image_paths[index % len(image_paths)]) for index in range(jobs_count)]
+
+    parse_latencies = []
+    started_at = time.monotonic()
+    for key, response, error in run_ocr(jobs, provider, workers, stats=stats):
+        if error is not None:
+            continue
+        parse_started_at = time.monotonic()
+        get_vote_counts(extract_tables(response))
+        parse_latencies.append(time.monotonic() - parse_started_at)
+    wall = time.monotonic() - started_at
+
+    uploaded = stats.providers[provider.name]['bytes']
+    return [
+        stage_result('textract ocr', wall, stats.latencies, uploaded, workers=workers),
+        stage_result('textract parse', sum(parse_latencies), parse_latencies),
+    ]
+
+
+def print_results(results, baseline=None):
+    baseline_rates = {result['stage']: result['rate'] for result in baseline or []}
+    print(f'{"stage":<24} {"wall s":>8} {"count":>8} {"per s":>9} {"p50 ms":>8} {"p99 ms":>8} {"MB":>8}')
+    for result in results:
+        p50 = f'{result["p50_ms"]:.1f}' if result['p50_ms'] is not None else '-'
+        p99 = f'{result["p99_ms"]:.1f}' if result['p99_ms'] is not None else '-'
+        line = (f'{result["stage"]:<24} {result["wall"]:>8.2f} {result["count"]:>8} {result["rate"]:>9.1f} '
+                f'{p50:>8} {p99:>8} {result["bytes"] / 1e6:>8.1f}')
+        if result.get('statuses'):
+            line += f'  {result["statuses"]}'
+
+        baseline_rate = baseline_rates.get(result['stage'])
+        if baseline_rate:
+            change = result['rate'] / baseline_rate - 1
+            line += f'  {change:+.0%} vs baseline'
+            if change < -REGRESSION_THRESHOLD:
+                line += ' REGRESSION'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scrapers against a local mirror and the OCR pipeline.')
+    parser.add_argument('--root', default='.', help='Directory holding the saved tree, images and Textract data')
+    parser.add_argument('--levels', nargs='*', choices=LEVELS, default=list(LEVELS),
+                        help='Scrapers to benchmark, none skips the crawl')
+    parser.add_argument('--cities', nargs='+', type=int, help='Only crawl these city IDs')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--rate', type=float, default=1000.0, help='Initial requests per second of the crawler')
+    parser.add_argument('--max-rate', type=float, default=5000.0)
+    parser.add_argument('--latency', type=float, default=0.02, help='Mean seconds the mirror adds to each response')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='Share of mirror responses that are 503')
+    parser.add_argument('--port', type=int, default=MIRROR_PORT)
+    parser.add_argument('--ocr-jobs', type=int, default=200, help='Images sent through the fake OCR, 0 skips it')
+    parser.add_argument('--ocr-latency', type=float, default=0.05, help='Seconds each fake OCR call takes')
+    parser.add_argument('--ocr-workers', type=int, default=8)
+    parser.add_argument('--output', help='Save the results as JSON, e.g. as a later baseline')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare throughput with')
+    args = parser.parse_args()
+    if args.rate > args.max_rate:
+        parser.error('--rate cannot be above --max-rate, the limiter would clamp it')
+
+    results = []
+    if args.levels:
+        with mirror_server(args.root, args.port, args.latency, args.error_rate) as base_url:
+            for level in args.levels:
+                print(f'Benchmarking the {level} scraper...')
+                results.append(bench_crawl(level, args.root, set(args.cities) if args.cities else None,
+                                           base_url, args.concurrency, args.rate, args.max_rate))
+
+    image_paths = sample_images(args.root)
+    if args.ocr_jobs and not image_paths:
+        print('No sample images next to saved Textract data, skipping the textract pipeline')
+    elif args.ocr_jobs:
+        print(f'Benchmarking the textract pipeline on {len(image_paths)} sample images...')
+        results.append(bench_preprocess(image_paths))
+        results.extend(bench_textract(args.root, image_paths, args.ocr_jobs, args.ocr_latency, args.ocr_workers))
+
+    baseline = read_json(args.baseline) if args.baseline else None
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        print(f'Saved the results to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
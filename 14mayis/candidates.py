@@ -0,0 +1,137 @@
+import re
+
+from textract_tables import normalize_text
+
+# The candidate names to extract vote counts for, with the OCR typos seen on the tutanaks
+CANDIDATES = {
+    "RECEP TAYYIP ERDOGAN": ["RECEP TAYYIP ERDOGAN", "RECEP TAYYP ERDOGAN", "RECEP TAYYIP ERD0GAN", "RECEP TAYYP ERD0GAN", "RECEP TAYYIP ERD0GAN"],
+    "MUHARREM INCE": ["MUHARREM INCE", "MUHARREM 1NCE", "MUHAREM INCE", "MUHARREM INÇE"],
+    "KEMAL KILICDAROGLU": ["KEMAL KILICDAROGLU", "KEMAL KILICOAROGLU", "KEMAL K1LICDAROGLU", "KEMA_ KILICDAROGLU", "KEMAL KILICDAR0GLU", "KEMA_ K1LICDAR0GLU"],
+    "SINAN OGAN": ["SINAN OGAN", "SINAN 0GAN", "S1NAN OGAN", "SINAN OG_N", "S1NAN 0G_N", "SNAN 0GAN"],
+}
+TOTAL = "TOPLAM"
+
+# The keys of the candidates in the API's cm_result votes, in ballot order
+VOTE_KEYS = {
+    "1": "RECEP TAYYIP ERDOGAN",
+    "2": "MUHARREM INCE",
+    "3": "KEMAL KILICDAROGLU",
+    "4": "SINAN OGAN",
+}
+
+NUMBER = re.compile(r'\d+')
+
+# Characters OCR mixes up, a substitution between them costs half an edit. Turkish letters such as
+# Ç/C or İ/I are already folded by normalize_text before matching.
+OCR_CONFUSIONS = [
+    ('0', 'O'), ('0', 'D'), ('O', 'D'), ('O', 'Q'), ('1', 'I'), ('1', 'L'), ('I', 'L'), ('I', 'T'),
+    ('5', 'S'), ('8', 'B'), ('6', 'G'), ('2', 'Z'), ('C', 'G'), ('U', 'V'), ('M', 'N'), ('R', 'K'),
+]
+CONFUSION_COST = 0.5
+
+# Largest weighted edit distance accepted, as a share of the name's length
+MAX_DISTANCE_RATIO = 0.2
+
+
+class FuzzyName:
+    # One candidate name prepared for bounded edit distance: the substitution cost of every
+    # character of the name against any text character is looked up instead of recomputed
+    def __init__(self, name, candidate, confusions):
+        self.name = name
+        self.candidate = candidate
+        self.max_distance = max(1.0, int(len(name) * MAX_DISTANCE_RATIO))
+        self.substitution_costs = []
+        for character in name:
+            costs = {character: 0.0}
+            for first, second in confusions:
+                if character == first:
+                    costs[second] = CONFUSION_COST
+                elif character == second:
+                    costs[first] = CONFUSION_COST
+            self.substitution_costs.append(costs)
+
+    def distance(self, text):
+        # Weighted edit distance between the name and the best suffix of text, as a name cell
+        # matches when it ends with the name. Gives up once every path exceeds max_distance.
+        max_distance = self.max_distance
+        text = text[-(len(self.name) + int(max_distance)):]
+        previous = [0.0] * (len(text) + 1)
+        for row, costs in enumerate(self.substitution_costs, 1):
+            current = [float(row)]
+            for column, character in enumerate(text, 1):
+                current.append(min(previous[column - 1] + costs.get(character, 1.0),
+                                   previous[column] + 1.0,
+                                   current[column - 1] + 1.0))
+            if min(current) > max_distance:
+                return None
+            previous = current
+        return previous[-1] if previous[-1] <= max_distance else None
+
+
+class AliasIndex:
+    # Maps every normalized alias to its candidate. A name cell matches when it ends with an alias,
+    # so a lookup is one dictionary probe for the whole cell, then one per distinct alias length.
+    # Cells without an exact alias are scored against the canonical names only, so adding aliases
+    # never makes the fuzzy pass slower. TOPLAM is matched exactly: one edit away from it are
+    # other rows of the tutanak such as GECERLI OY TOPLAMI.
+    def __init__(self, candidates=CANDIDATES, confusions=OCR_CONFUSIONS, cache_size=100000):
+        self.aliases = {normalize_text(TOTAL): TOTAL}
+        for candidate, aliases in candidates.items():
+            for alias in [candidate] + aliases:
+                self.aliases.setdefault(normalize_text(alias), candidate)
+        self.lengths = sorted({len(alias) for alias in self.aliases}, reverse=True)
+
+        self.fuzzy_names = [FuzzyName(normalize_text(candidate), candidate, confusions)
+                            for candidate in candidates]
+        self.cache = {}
+        self.cache_size = cache_size
+
+    def match(self, text):
+        candidate = self.aliases.get(text)
+        if candidate is not None:
+            return candidate
+        for length in self.lengths:
+            if length <= len(text) and text[-length:] in self.aliases:
+                return self.aliases[text[-length:]]
+        return self.fuzzy_match(text)
+
+    def fuzzy_match(self, text):
+        # Header cells repeat on every tutanak, so results are cached per text
+        if text in self.cache:
+            return self.cache[text]
+
+        best_candidate = None
+        best_distance = None
+        for fuzzy_name in self.fuzzy_names:
+            if len(text) < len(fuzzy_name.name) - fuzzy_name.max_distance:
+                continue
+            distance = fuzzy_name.distance(text)
+            if distance is not None and (best_distance is None or distance < best_distance):
+                best_candidate, best_distance = fuzzy_name.candidate, distance
+
+        if len(self.cache) < self.cache_size:
+            self.cache[text] = best_candidate
+        return best_candidate
+
+
+DEFAULT_INDEX = AliasIndex()
+
+
+def get_vote_counts(tables, index=DEFAULT_INDEX):
+    # Scan every row once, a candidate's count is the number in the cell after its name.
+    # The first row that has one wins, TOPLAM is read the same way.
+    vote_counts = {}
+    for table in tables:
+        for row in table.rows:
+            if len(row) < 2:
+                continue
+            texts = [normalize_text(cell.text) for cell in row]
+            for position in range(len(texts) - 1):
+                # Only cells followed by a number can be a candidate's row
+                number = NUMBER.match(texts[position + 1])
+                if not number or not texts[position]:
+                    continue
+                candidate = index.match(texts[position])
+                if candidate is not None and candidate not in vote_counts:
+                    vote_counts[candidate] = int(number.group())
+    return vote_counts
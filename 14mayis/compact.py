@@ -0,0 +1,168 @@
+import argparse
+import os
+from glob import glob
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+from files import atomic_write, read_json
+
+DATASET_DIR = 'dataset'
+TABLES = ('cities', 'districts', 'neighborhoods', 'schools', 'ballot_boxes')
+
+# The two tutanak kinds of a ballot box: presidential (cm) and parliamentary (mv)
+RESULT_KINDS = ('cm', 'mv')
+
+
+def file_id(filename):
+    return int(os.path.splitext(os.path.basename(filename))[0])
+
+
+def build_hierarchy(root='.'):
+    cities = {'id': [], 'name': []}
+    districts = {'city_id': [], 'id': [], 'name': []}
+    neighborhoods = {'city_id': [], 'district_id': [], 'id': [], 'name': []}
+    schools = {'city_id': [], 'district_id': [], 'neighborhood_id': [], 'id': [], 'name': []}
+
+    for city_item in read_json(os.path.join(root, 'cities.json')):
+        cities['id'].append(city_item['id'])
+        cities['name'].append(city_item['name'])
+
+    for filename in glob(os.path.join(root, 'districts', '*.json')):
+        city_id = file_id(filename)
+        for district_item in read_json(filename):
+            districts['city_id'].append(city_id)
+            districts['id'].append(district_item['id'])
+            districts['name'].append(district_item['name'])
+
+    for filename in glob(os.path.join(root, 'neighborhoods', '*', '*.json')):
+        city_id = int(os.path.basename(os.path.dirname(filename)))
+        district_id = file_id(filename)
+        for neighborhood_item in read_json(filename):
+            neighborhoods['city_id'].append(city_id)
+            neighborhoods['district_id'].append(district_id)
+            neighborhoods['id'].append(neighborhood_item['id'])
+            neighborhoods['name'].append(neighborhood_item['name'])
+
+    for filename in glob(os.path.join(root, 'schools', '*', '*', '*.json')):
+        district_dir = os.path.dirname(filename)
+        city_id = int(os.path.basename(os.path.dirname(district_dir)))
+        district_id = int(os.path.basename(district_dir))
+        neighborhood_id = file_id(filename)
+        schools_data = read_json(filename)
+        if not isinstance(schools_data, list):
+            continue
+        for school_item in schools_data:
+            schools['city_id'].append(city_id)
+            schools['district_id'].append(district_id)
+            schools['neighborhood_id'].append(neighborhood_id)
+            schools['id'].append(school_item['id'])
+            schools['name'].append(school_item['name'])
+
+    return {
+        'cities': pa.table(cities, schema=pa.schema([
+            ('id', pa.int32()), ('name', pa.string())])),
+        'districts': pa.table(districts, schema=pa.schema([
+            ('city_id', pa.int32()), ('id', pa.int32()), ('name', pa.string())])),
+        'neighborhoods': pa.table(neighborhoods, schema=pa.schema([
+            ('city_id', pa.int32()), ('district_id', pa.int32()), ('id', pa.int32()), ('name', pa.string())])),
+        'schools': pa.table(schools, schema=pa.schema([
+            ('city_id', pa.int32()), ('district_id', pa.int32()), ('neighborhood_id', pa.int32()),
+            ('id', pa.int32()), ('name', pa.string())])),
+    }
+
+
+def build_ballot_boxes(root='.'):
+    rows = []
+    candidate_ids = {kind: set() for kind in RESULT_KINDS}
+    for filename in glob(os.path.join(root, 'ballot_boxes_in_school', '*.json')):
+        school_id = file_id(filename)
+        for ballot_box in read_json(filename):
+            rows.append((school_id, ballot_box))
+            for kind in RESULT_KINDS:
+                result = ballot_box.get(f'{kind}_result')
+                if result:
+                    candidate_ids[kind].update(result.get('votes', {}))
+
+    columns = {
+        'school_id': [],
+        'ballot_box_number': [],
+        'school_name': [],
+    }
+    fields = [
+        ('school_id', pa.int32()),
+        ('ballot_box_number', pa.int32()),
+        ('school_name', pa.dictionary(pa.int32(), pa.string())),
+    ]
+    # Every candidate (cm) or party (mv) gets its own integer column, e.g. cm_votes_1
+    vote_columns = {}
+    for kind in RESULT_KINDS:
+        for column, field_type in (('submission_id', pa.int64()), ('image_url', pa.string()),
+                                   ('total_vote', pa.int32())):
+            columns[f'{kind}_{column}'] = []
+            fields.append((f'{kind}_{column}', field_type))
+        vote_columns[kind] = sorted(candidate_ids[kind], key=int)
+        for candidate_id in vote_columns[kind]:
+            columns[f'{kind}_votes_{candidate_id}'] = []
+            fields.append((f'{kind}_votes_{candidate_id}', pa.int32()))
+
+    for school_id, ballot_box in rows:
+        columns['school_id'].append(school_id)
+        columns['ballot_box_number'].append(ballot_box.get('ballot_box_number'))
+        columns['school_name'].append(ballot_box.get('school_name'))
+        for kind in RESULT_KINDS:
+            result = ballot_box.get(f'{kind}_result')
+            columns[f'{kind}_submission_id'].append(result['submission_id'] if result else None)
+            columns[f'{kind}_image_url'].append(result['image_url'] if result else None)
+            columns[f'{kind}_total_vote'].append(result['total_vote'] if result else None)
+            # Candidates without votes are left out of the API response
+            votes = result.get('votes', {}) if result else None
+            for candidate_id in vote_columns[kind]:
+                columns[f'{kind}_votes_{candidate_id}'].append(
+                    None if votes is None else votes.get(candidate_id, 0))
+
+    schema = pa.schema(fields)
+    return pa.table({name: pa.array(columns[name], type=schema.field(name).type) for name in schema.names},
+                    schema=schema)
+
+
+def write_dataset(tables, dataset_dir=DATASET_DIR, file_format='arrow'):
+    os.makedirs(dataset_dir, exist_ok=True)
+    for name, table in tables.items():
+        filename = os.path.join(dataset_dir, f'{name}.{file_format}')
+        with atomic_write(filename) as outfile:
+            if file_format == 'parquet':
+                pq.write_table(table, outfile)
+            else:
+                # Uncompressed Arrow IPC files can be memory-mapped without copying
+                with ipc.new_file(outfile, table.schema) as writer:
+                    writer.write_table(table)
+        print(f'Saved {table.num_rows} {name} to {filename}')
+
+
+def load_table(name, dataset_dir=DATASET_DIR):
+    arrow_filename = os.path.join(dataset_dir, f'{name}.arrow')
+    if os.path.exists(arrow_filename):
+        return ipc.open_file(pa.memory_map(arrow_filename, 'r')).read_all()
+    return pq.read_table(os.path.join(dataset_dir, f'{name}.parquet'), memory_map=True)
+
+
+def load_dataset(dataset_dir=DATASET_DIR):
+    return {name: load_table(name, dataset_dir) for name in TABLES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the scraped JSON tree into columnar tables.')
+    parser.add_argument('--root', default='.', help='Directory holding cities.json and the output tree')
+    parser.add_argument('--output', default=DATASET_DIR)
+    parser.add_argument('--format', choices=('arrow', 'parquet'), default='arrow')
+    args = parser.parse_args()
+
+    tables = build_hierarchy(args.root)
+    tables['ballot_boxes'] = build_ballot_boxes(args.root)
+    write_dataset(tables, args.output, args.format)
+
+
+if __name__ == "__main__":
+    main()
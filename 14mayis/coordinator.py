@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import time
+from glob import glob
+
+from crawler import API_BASE, ENTITIES, YURTDISI_CITY_ID, Crawler
+from files import atomic_write, read_json
+from metrics import add_arguments, instrumented
+from rate_limiter import API_LIMITER
+from work_queue import DONE, LEASED, PENDING, WorkQueue, default_owner, heartbeat
+
+LEDGER_FILENAME = 'crawl_ledger.sqlite'
+SHARD = 'shard'
+SHARDS_DIR = 'shards'
+
+# The ledger is shared by workers on several hosts, where SQLite's WAL mode does not work. The
+# rollback journal relies on file locks, so the ledger needs a filesystem whose locks work.
+LEDGER_JOURNAL_MODE = 'DELETE'
+
+# Written into a shard's directory once its crawl finished, merge only takes finished shards
+SHARD_FILENAME = 'shard.json'
+
+# The directories of the output tree, cities.json is the coordinator's own
+TREE_DIRS = sorted({filename_parts[0] for level, path, filename_parts, description in ENTITIES.values()})
+
+
+def plan_shards(root='.'):
+    # One shard per district of the cities whose districts are known, one per city for the others.
+    # The number of neighborhoods weighs each shard, so the largest are claimed first.
+    shards = []
+    for city_item in read_json(os.path.join(root, 'cities.json')):
+        city_id = city_item['id']
+        districts_filename = os.path.join(root, 'districts', f'{city_id}.json')
+        if city_id == YURTDISI_CITY_ID or not os.path.exists(districts_filename):
+            shards.append((str(city_id), 1, {'city': city_item, 'district_ids': None}))
+            continue
+        for district_item in read_json(districts_filename):
+            district_id = district_item['id']
+            neighborhoods_filename = os.path.join(root, 'neighborhoods', str(city_id), f'{district_id}.json')
+            weight = len(read_json(neighborhoods_filename)) if os.path.exists(neighborhoods_filename) else 1
+            shards.append((f'{city_id}/{district_id}', weight, {'city': city_item, 'district_ids': [district_id]}))
+    return shards
+
+
+def shard_root(worker_root, key):
+    return os.path.join(worker_root, SHARDS_DIR, key.replace('/', '-'))
+
+
+async def crawl_shard(ledger, key, owner, crawler):
+    # Returns whether the worker held the lease throughout the crawl
+    heartbeat_task = asyncio.create_task(heartbeat(ledger, SHARD, key, owner))
+    try:
+        await crawler.run()
+    finally:
+        lost = heartbeat_task.done()
+        heartbeat_task.cancel()
+    if lost:
+        # Raises whatever stopped the heartbeat other than losing the lease
+        heartbeat_task.result()
+    return not lost
+
+
+def work(args):
+    # Claim shards until none is left, every one is crawled into its own directory under the worker's root
+    ledger = WorkQueue(args.ledger, lease_seconds=args.lease_seconds, journal_mode=LEDGER_JOURNAL_MODE)
+    owner = args.worker or default_owner()
+    API_LIMITER.set_rate(args.rate)
+    API_LIMITER.max_rate = args.max_rate
+    crawlers = []
+
+    def progress():
+        return crawlers[-1].progress() if crawlers else 'Waiting for a shard'
+
+    try:
+        with instrumented(args, progress):
+            crawled = work_shards(args, ledger, owner, crawlers)
+    finally:
+        ledger.close()
+    print(f'{owner} crawled {crawled} shards')
+
+
+def work_shards(args, ledger, owner, crawlers):
+    crawled = 0
+    # Shards given back with failures this run, held when they come up again so the others get crawled
+    released = set()
+    held = set()
+    while True:
+        item = ledger.pop(SHARD, owner)
+        if item is None:
+            break
+        key, payload = item
+        if key in released:
+            held.add(key)
+            continue
+        print(f'{owner} crawling shard {key}')
+        root = shard_root(args.root, key)
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, 'cities.json'), 'w') as outfile:
+            json.dump([payload['city']], outfile)
+
+        crawler = Crawler(concurrency=args.concurrency, base_url=args.base_url, root=root,
+                          district_ids=payload['district_ids'])
+        crawlers[:] = [crawler]
+        owned = asyncio.run(crawl_shard(ledger, key, owner, crawler))
+
+        if not owned:
+            # The shard went to another worker, which completes it
+            continue
+        if len(crawler.retry_queue):
+            # Hand the shard back, its crawl state resumes the failed requests on the next lease
+            print(f'Releasing shard {key} with {len(crawler.retry_queue)} requests still failing')
+            ledger.release(SHARD, key, owner)
+            released.add(key)
+            continue
+
+        shard_filename = os.path.join(root, SHARD_FILENAME)
+        with open(shard_filename, 'w') as outfile:
+            json.dump({'shard': key, 'worker': owner, 'finished_at': time.time()}, outfile)
+        if not ledger.complete(SHARD, key, owner):
+            # The lease ran out since the last heartbeat, merge takes the other worker's crawl
+            print(f'Lost the lease of shard {key} before completing it')
+            os.remove(shard_filename)
+            continue
+        crawled += 1
+
+    for key in held:
+        ledger.release(SHARD, key, owner)
+    if held:
+        print(f'{len(held)} shards still have failing requests, they are retried by the next worker')
+    return crawled
+
+
+def copy_file(source, target):
+    # Replace the target atomically, identical files are left alone
+    if os.path.exists(target) and os.path.getsize(source) == os.path.getsize(target):
+        with open(source, 'rb') as source_file, open(target, 'rb') as target_file:
+            if source_file.read() == target_file.read():
+                return False
+    with open(source, 'rb') as source_file, atomic_write(target) as outfile:
+        shutil.copyfileobj(source_file, outfile)
+    return True
+
+
+def merge(ledger_filename, worker_roots, target_root):
+    # Copy the finished shards of every worker into one tree. A shard crawled twice after its lease
+    # expired is taken from the worker that finished last, shards overlap only in districts/{city}.json.
+    ledger = WorkQueue(ledger_filename, journal_mode=LEDGER_JOURNAL_MODE)
+    done = ledger.keys(SHARD, DONE)
+    ledger.close()
+
+    finished = {}
+    for worker_root in worker_roots:
+        for shard_filename in glob(os.path.join(worker_root, SHARDS_DIR, '*', SHARD_FILENAME)):
+            shard = read_json(shard_filename)
+            if shard['shard'] in done and shard['finished_at'] > finished.get(shard['shard'], (0,))[0]:
+                finished[shard['shard']] = (shard['finished_at'], os.path.dirname(shard_filename))
+
+    copied = 0
+    for finished_at, root in sorted(finished.values()):
+        for directory in TREE_DIRS:
+            for source in glob(os.path.join(root, directory, '**', '*.json'), recursive=True):
+                copied += copy_file(source, os.path.join(target_root, os.path.relpath(source, root)))
+    print(f'Merged {len(finished)} shards into {target_root}, {copied} files copied')
+    missing = done - set(finished)
+    if missing:
+        print(f'{len(missing)} finished shards were not found under the given worker roots: '
+              f'{", ".join(sorted(missing))}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Split the crawl into city and district shards leased from a shared ledger, so several '
+                    'workers with their own IPs crawl in parallel, then merge their trees.')
+    parser.add_argument('command', choices=('plan', 'work', 'merge', 'status'))
+    parser.add_argument('--ledger', default=LEDGER_FILENAME,
+                        help='SQLite ledger of the shards, on storage every worker can reach with working file locks')
+    parser.add_argument('--root', default='.',
+                        help='plan: the tree with cities.json, work: where the shards are crawled, merge: the output tree')
+    parser.add_argument('--lease-seconds', type=float, default=300.0,
+                        help='A shard whose worker stops heartbeating for this long is handed out again')
+    parser.add_argument('--worker', help='Name recorded with the leases, host and PID by default')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rate', type=float, default=API_LIMITER.rate)
+    parser.add_argument('--max-rate', type=float, default=API_LIMITER.max_rate)
+    parser.add_argument('--base-url', default=API_BASE)
+    parser.add_argument('--from', dest='worker_roots', nargs='+', default=[], metavar='ROOT',
+                        help='merge: the roots the workers crawled into')
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.rate > args.max_rate:
+        parser.error('--rate cannot be above --max-rate, the limiter would clamp it')
+
+    if args.command == 'plan':
+        ledger = WorkQueue(args.ledger, journal_mode=LEDGER_JOURNAL_MODE)
+        shards = plan_shards(args.root)
+        ledger.push(SHARD, shards)
+        ledger.close()
+        print(f'Planned {len(shards)} shards in {args.ledger}')
+    elif args.command == 'work':
+        work(args)
+    elif args.command == 'merge':
+        merge(args.ledger, args.worker_roots, args.root)
+    else:
+        ledger = WorkQueue(args.ledger, journal_mode=LEDGER_JOURNAL_MODE)
+        statuses = {status: count for kind, status, count, max_priority in ledger.counts() if kind == SHARD}
+        for worker, key, leased_until in ledger.leases(SHARD):
+            state = 'expired' if leased_until < time.time() else f'{leased_until - time.time():.0f}s left'
+            print(f'{worker:<30} {key:<12} {state}')
+        ledger.close()
+        print(', '.join(f'{statuses.get(status, 0)} {status}' for status in (PENDING, LEASED, DONE)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import time
+
+STATE_FILENAME = 'crawl_state.sqlite'
+
+# Fetch statuses of an entity
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    path TEXT PRIMARY KEY,
+    level TEXT NOT NULL,
+    task TEXT NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    http_status TEXT,
+    fetched_at REAL,
+    content_hash TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    volatile INTEGER
+);
+CREATE INDEX IF NOT EXISTS entities_status ON entities (status, level);
+"""
+
+# Columns added after the first version of the schema, added to older state files on open
+MIGRATIONS = {
+    'etag': 'ALTER TABLE entities ADD COLUMN etag TEXT',
+    'last_modified': 'ALTER TABLE entities ADD COLUMN last_modified TEXT',
+    'volatile': 'ALTER TABLE entities ADD COLUMN volatile INTEGER',
+}
+
+
+class CrawlState:
+    # Every entity of the hierarchy is one row keyed by its API path, so a restart only has to
+    # query the rows that are not done instead of checking every file on disk
+    def __init__(self, filename, commit_every=500):
+        self.filename = filename
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        columns = {row[1] for row in self.connection.execute('PRAGMA table_info(entities)')}
+        for column, statement in MIGRATIONS.items():
+            if column not in columns:
+                self.connection.execute(statement)
+        self.connection.commit()
+
+    def is_empty(self):
+        return self.connection.execute('SELECT 1 FROM entities LIMIT 1').fetchone() is None
+
+    def add_pending(self, entities):
+        # entities are (path, level, task, args) tuples discovered from a parent's response
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO entities (path, level, task, args) VALUES (?, ?, ?, ?)',
+            [(path, level, task, json.dumps(list(args))) for path, level, task, args in entities])
+        self.uncommitted += len(entities)
+
+    def mark(self, path, level, task, args, status, http_status=None, content_hash=None,
+             etag=None, last_modified=None, volatile=None):
+        self.connection.execute(
+            'INSERT INTO entities (path, level, task, args, status, http_status, fetched_at, content_hash, '
+            'etag, last_modified, volatile) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (path) DO UPDATE SET status = excluded.status, http_status = excluded.http_status, '
+            'fetched_at = excluded.fetched_at, content_hash = COALESCE(excluded.content_hash, content_hash), '
+            'etag = COALESCE(excluded.etag, etag), last_modified = COALESCE(excluded.last_modified, last_modified), '
+            'volatile = COALESCE(excluded.volatile, volatile)',
+            (path, level, task, json.dumps(list(args)), status,
+             None if http_status is None else str(http_status), time.time(), content_hash,
+             etag, last_modified, None if volatile is None else int(volatile)))
+        self.uncommitted += 1
+
+    def touch(self, path, http_status):
+        # The entity was polled again and has not changed
+        self.connection.execute(
+            'UPDATE entities SET http_status = ?, fetched_at = ? WHERE path = ?',
+            (str(http_status), time.time(), path))
+        self.uncommitted += 1
+
+    def unfinished(self, levels):
+        # One indexed query for everything that still has to be fetched
+        placeholders = ', '.join('?' for _ in levels)
+        rows = self.connection.execute(
+            f'SELECT task, args, status, http_status FROM entities '
+            f'WHERE status IN (?, ?) AND level IN ({placeholders})',
+            (PENDING, FAILED, *levels))
+        return [(task, json.loads(args), status, http_status) for task, args, status, http_status in rows]
+
+    def refreshable(self, level, everything=False):
+        # Entities whose data may still change, or every fetched entity of the level.
+        # Rows recorded before volatility was tracked are refreshed to find out.
+        query = ('SELECT path, task, args, content_hash, etag, last_modified FROM entities '
+                 'WHERE status = ? AND level = ?')
+        if not everything:
+            query += ' AND (volatile IS NULL OR volatile != 0)'
+        rows = self.connection.execute(query, (DONE, level))
+        return [(path, task, json.loads(args), previous_hash, etag, last_modified)
+                for path, task, args, previous_hash, etag, last_modified in rows]
+
+    def refresh_row(self, path):
+        # The refreshable() row of one fetched entity, None when it was not fetched yet
+        row = self.connection.execute(
+            'SELECT path, task, args, content_hash, etag, last_modified FROM entities WHERE path = ? AND status = ?',
+            (path, DONE)).fetchone()
+        if row is None:
+            return None
+        path, task, args, previous_hash, etag, last_modified = row
+        return path, task, json.loads(args), previous_hash, etag, last_modified
+
+    def counts(self):
+        return self.connection.execute(
+            'SELECT level, status, COUNT(*) FROM entities GROUP BY level, status ORDER BY level, status').fetchall()
+
+    def checkpoint(self):
+        # Commits are batched, so callers checkpoint only once an entity and its children are both
+        # recorded. Anything lost in a crash is simply fetched again.
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def main():
+    state = CrawlState(STATE_FILENAME)
+    for level, status, count in state.counts():
+        print(f'{level:<14} {status:<8} {count}')
+    state.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import aiohttp
+
+from crawl_state import DONE, FAILED, STATE_FILENAME, CrawlState
+from files import read_json, write_text
+from metrics import METRICS, add_arguments, instrumented
+from rate_limiter import API_LIMITER, RETRY_STATUSES, THROTTLE_STATUSES, RetryQueue, backoff_delay
+from work_queue import FETCH, QUEUE_FILENAME, WorkQueue, default_owner, heartbeat
+
+API_BASE = 'https://api-sonuc.oyveotesi.org/api/v1'
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36"
+}
+
+# The levels of the cities -> districts -> neighborhoods -> schools -> ballot boxes hierarchy
+LEVELS = ('districts', 'neighborhoods', 'schools', 'ballot_boxes')
+
+# The "Yurtdisi" city has no neighborhoods
+YURTDISI_CITY_ID = 82
+
+
+# The file and API path of every crawl task, formatted with the task's arguments
+ENTITIES = {
+    'crawl_city': (
+        'districts',
+        'cities/{0}/districts',
+        ('districts', '{0}.json'),
+        'city ID {0}'),
+    'crawl_district': (
+        'neighborhoods',
+        'cities/{0}/districts/{1}/neighborhoods',
+        ('neighborhoods', '{0}', '{1}.json'),
+        'city ID {0}, district ID {1}'),
+    'crawl_neighborhood': (
+        'schools',
+        'cities/{0}/districts/{1}/neighborhoods/{2}/schools',
+        ('schools', '{0}', '{1}', '{2}.json'),
+        'city ID {0}, district ID {1}, neighborhood ID {2}'),
+    'crawl_school': (
+        'ballot_boxes',
+        'submission/school/{0}',
+        ('ballot_boxes_in_school', '{0}.json'),
+        'school ID {0}'),
+}
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def may_change(ballot_boxes_data):
+    # Schools with ballot boxes still waiting for a tutanak can get new results
+    return any(ballot_box.get('cm_result') is None or ballot_box.get('mv_result') is None
+               for ballot_box in ballot_boxes_data)
+
+
+def is_retryable(status):
+    # Connection errors are reported by name, HTTP errors by status code
+    return isinstance(status, str) or status in RETRY_STATUSES
+
+
+class Crawler:
+    def __init__(self, levels=LEVELS, concurrency=16, base_url=API_BASE, root='.',
+                 limiter=API_LIMITER, max_attempts=5, trace_configs=None, district_ids=None, on_change=None):
+        unknown_levels = set(levels) - set(LEVELS)
+        if unknown_levels:
+            raise ValueError(f'Unknown crawl levels: {", ".join(sorted(unknown_levels))}')
+
+        self.levels = set(levels)
+        self.concurrency = concurrency
+        self.base_url = base_url.rstrip('/')
+        self.root = root
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        # aiohttp TraceConfigs, e.g. to time every request in bench.py
+        self.trace_configs = trace_configs
+        # Only crawl these districts of the cities in cities.json, e.g. one shard of coordinator.py
+        self.district_ids = set(district_ids) if district_ids is not None else None
+        # Called with (task, args, previous_data, data) for every entity a refresh finds changed
+        self.on_change = on_change
+        self.retry_queue = RetryQueue()
+        self.changed = []
+        self.started_at = time.monotonic()
+        # METRICS counts for the whole process, earlier crawlers' requests are not this one's rate
+        self.last_progress = (self.started_at, METRICS.total('http_requests_total'))
+        self.state = None
+        self.session = None
+        self.semaphore = None
+        self.task_group = None
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    async def run(self, refresh=False, everything=False, queue=None):
+        # One pooled session is shared by every request of the crawl
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=60)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        self.state = CrawlState(self.path(STATE_FILENAME))
+        try:
+            async with aiohttp.ClientSession(headers=HEADERS, connector=connector, timeout=timeout,
+                                             trace_configs=self.trace_configs) as session:
+                self.session = session
+                if queue is not None:
+                    await self.work(queue)
+                elif refresh:
+                    await self.refresh(everything)
+                else:
+                    await self.crawl()
+        finally:
+            self.state.close()
+            self.state = None
+            self.session = None
+            self.task_group = None
+
+    async def crawl(self):
+        city_ids = [city_item['id'] for city_item in read_json(self.path('cities.json'))]
+        first_run = self.state.is_empty()
+        self.add_children('crawl_city', [(city_id,) for city_id in city_ids])
+
+        async with asyncio.TaskGroup() as task_group:
+            self.task_group = task_group
+            if first_run:
+                # Walk the tree once, files of an earlier crawl are read and recorded in the state
+                for city_id in city_ids:
+                    self.spawn(self.crawl_city(city_id))
+            else:
+                # Only the entities that are missing or failed have to be fetched again. Their ancestors
+                # are resumed too, a run of shallower levels stops at them without recording their children.
+                deepest = max(LEVELS.index(level) for level in self.levels)
+                unfinished = self.state.unfinished(LEVELS[:deepest + 1])
+                print(f'Resuming {len(unfinished)} unfinished entities')
+                for task, args, status, http_status in unfinished:
+                    self.spawn(getattr(self, task)(*args))
+
+        # Give the requests that failed during the crawl one more pass once the pipeline has drained
+        retry_items = [item for item in self.retry_queue.drain() if is_retryable(item['status'])]
+        if retry_items:
+            print(f'Retrying {len(retry_items)} failed requests')
+            async with asyncio.TaskGroup() as task_group:
+                self.task_group = task_group
+                for item in retry_items:
+                    self.spawn(getattr(self, item['task'])(*item['args']))
+
+        if len(self.retry_queue):
+            print(f'{len(self.retry_queue)} requests still failing, they are retried on the next run')
+
+    def spawn(self, coroutine):
+        # Children are scheduled as soon as their parent resolves, so every level is fetched as one pipeline
+        METRICS.add('crawler_tasks', 1)
+        task = self.task_group.create_task(coroutine)
+        task.add_done_callback(lambda task: METRICS.add('crawler_tasks', -1))
+
+    def progress(self):
+        # One line summing up the crawl so far, printed periodically instead of a line per file
+        now = time.monotonic()
+        requests = METRICS.total('http_requests_total')
+        last_time, last_requests = self.last_progress
+        self.last_progress = (now, requests)
+        rate = (requests - last_requests) / (now - last_time) if now > last_time else 0.0
+
+        outcomes = METRICS.by_label('crawler_entities_total', 'outcome')
+        saved_levels = [(level, METRICS.total('crawler_entities_total', level=level, outcome='saved'))
+                        for level in LEVELS]
+        saved = ', '.join(f'{count} {level}' for level, count in saved_levels if count)
+        return (f'{now - self.started_at:.0f}s: {outcomes["saved"]} saved ({saved or "none"}), '
+                f'{outcomes["cached"]} read from disk, {outcomes["missing"]} missing, {outcomes["failed"]} failed, '
+                f'{METRICS.gauge("http_in_flight")} in flight, {METRICS.gauge("crawler_tasks")} tasks, '
+                f'{rate:.1f} req/s, rate limit {self.limiter.rate:.1f}/s')
+
+    async def fetch(self, url, headers=None, endpoint=''):
+        status = None
+        retry_after = None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                await asyncio.sleep(backoff_delay(attempt - 1, retry_after=retry_after))
+
+            retry_after = None
+            async with self.semaphore:
+                await self.limiter.acquire()
+                started_at = time.monotonic()
+                METRICS.add('http_in_flight', 1)
+                try:
+                    async with self.session.get(url, headers=headers) as response:
+                        status = response.status
+                        retry_after = response.headers.get('Retry-After')
+                        if status in (200, 304):
+                            data = json.loads(await response.read()) if status == 200 else None
+                            self.limiter.on_success(time.monotonic() - started_at, endpoint)
+                            self.record_request(endpoint, url, status, started_at, attempt)
+                            return status, data, response.headers
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    # Connection errors and timeouts are treated like an overloaded server
+                    status = type(error).__name__
+                    self.limiter.on_throttle()
+                    self.record_request(endpoint, url, status, started_at, attempt)
+                    continue
+                except ValueError:
+                    status = 'InvalidJSON'
+                    self.record_request(endpoint, url, status, started_at, attempt)
+                    continue
+                finally:
+                    METRICS.add('http_in_flight', -1)
+                self.record_request(endpoint, url, status, started_at, attempt)
+
+            if status in THROTTLE_STATUSES:
+                self.limiter.on_throttle()
+            elif not is_retryable(status):
+                break
+
+        return status, None, {}
+
+    def record_request(self, endpoint, url, status, started_at, attempt):
+        seconds = time.monotonic() - started_at
+        METRICS.observe('http_request_duration_seconds', seconds, endpoint=endpoint)
+        METRICS.inc('http_requests_total', endpoint=endpoint, status=status)
+        if status not in (200, 304):
+            METRICS.inc('http_errors_total', endpoint=endpoint, error=status)
+        METRICS.set('rate_limit', self.limiter.rate)
+        METRICS.trace('request', endpoint=endpoint, url=url, status=status, seconds=round(seconds, 6),
+                      attempt=attempt)
+
+    def entity(self, task, args):
+        level, path, filename_parts, description = ENTITIES[task]
+        filename = self.path(*[part.format(*args) for part in filename_parts])
+        return level, path.format(*args), filename, description.format(*args)
+
+    def add_children(self, task, children_args):
+        level, path, filename_parts, description = ENTITIES[task]
+        self.state.add_pending([(path.format(*args), level, task, args) for args in children_args])
+        self.state.checkpoint()
+
+    async def get(self, task, args, load=True):
+        level, path, filename, description = self.entity(task, args)
+
+        # Reuse the data of an earlier run if the file already exists
+        if os.path.exists(filename):
+            with open(filename) as file:
+                text = file.read()
+            data = json.loads(text) if load or level == 'ballot_boxes' else None
+            volatile = may_change(data) if level == 'ballot_boxes' else None
+            self.state.mark(path, level, task, args, DONE, content_hash=content_hash(text), volatile=volatile)
+            METRICS.inc('crawler_entities_total', level=level, outcome='cached')
+            return data if load else None
+
+        # Levels that are not being crawled are only read from disk
+        if level not in self.levels:
+            METRICS.inc('crawler_entities_total', level=level, outcome='missing')
+            METRICS.trace('missing', level=level, path=path)
+            return None
+
+        status, data, headers = await self.fetch(f'{self.base_url}/{path}', endpoint=level)
+        if data is None:
+            METRICS.inc('crawler_entities_total', level=level, outcome='failed')
+            print(f'Error retrieving {level} for {description}: {status}')
+            self.state.mark(path, level, task, args, FAILED, http_status=status)
+            self.retry_queue.push(task, args, status)
+            return None
+
+        text = json.dumps(data)
+        write_text(filename, text)
+        self.state.mark(path, level, task, args, DONE, http_status=status, content_hash=content_hash(text),
+                        etag=headers.get('ETag'), last_modified=headers.get('Last-Modified'),
+                        volatile=may_change(data) if level == 'ballot_boxes' else None)
+        METRICS.inc('crawler_entities_total', level=level, outcome='saved')
+        METRICS.trace('saved', level=level, path=path, filename=filename, bytes=len(text))
+        return data
+
+    async def refresh(self, everything=False):
+        # Poll the schools again and rewrite only the ones whose results changed
+        rows = self.state.refreshable('ballot_boxes', everything)
+        print(f'Refreshing {len(rows)} schools')
+        self.changed = []
+        async with asyncio.TaskGroup() as task_group:
+            self.task_group = task_group
+            for row in rows:
+                self.spawn(self.refresh_entity(*row))
+
+        print(f'{len(self.changed)} of {len(rows)} schools changed')
+        for description, filename in self.changed:
+            print(f'Updated {description} in {filename}')
+        return self.changed
+
+    async def refresh_entity(self, path, task, args, previous_hash, etag, last_modified):
+        level, path, filename, description = self.entity(task, args)
+
+        # Let the server answer 304 Not Modified where it supports conditional requests
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        status, data, response_headers = await self.fetch(f'{self.base_url}/{path}', headers, endpoint=level)
+        if status == 304:
+            METRICS.inc('crawler_refreshed_total', level=level, outcome='not_modified')
+            self.state.touch(path, status)
+        elif data is None:
+            # Keep the data we already have, the school is polled again on the next refresh
+            METRICS.inc('crawler_refreshed_total', level=level, outcome='failed')
+            print(f'Error refreshing {level} for {description}: {status}')
+            self.state.touch(path, status)
+        else:
+            text = json.dumps(data)
+            new_hash = content_hash(text)
+            if new_hash != previous_hash:
+                # The change is reported before the file is replaced, while the previous body is still on
+                # disk. A crash in between leaves the old file and hash, so the next round reports it again.
+                if self.on_change is not None:
+                    previous_data = read_json(filename) if os.path.exists(filename) else None
+                    self.on_change(task, args, previous_data, data)
+                write_text(filename, text)
+                self.changed.append((description, filename))
+                METRICS.inc('crawler_refreshed_total', level=level, outcome='changed')
+                METRICS.trace('changed', level=level, path=path, filename=filename)
+            else:
+                METRICS.inc('crawler_refreshed_total', level=level, outcome='unchanged')
+            self.state.mark(path, level, task, args, DONE, http_status=status, content_hash=new_hash,
+                            etag=response_headers.get('ETag'),
+                            last_modified=response_headers.get('Last-Modified'),
+                            volatile=may_change(data))
+        self.state.checkpoint()
+
+    async def work(self, queue):
+        # Fetch the schools scheduler.py queued, the most valuable first, until the queue is empty
+        self.changed = []
+        async with asyncio.TaskGroup() as task_group:
+            self.task_group = task_group
+            owner = default_owner()
+            for index in range(self.concurrency):
+                self.spawn(self.queue_worker(queue, f'{owner}-{index}'))
+        print(f'{len(self.changed)} schools changed')
+
+    async def queue_worker(self, queue, owner):
+        while True:
+            item = queue.pop(FETCH, owner)
+            if item is None:
+                return
+            key, payload = item
+            # Retries with backoff can outlast the lease, keep it until the school is saved
+            heartbeat_task = asyncio.create_task(heartbeat(queue, FETCH, key, owner))
+            try:
+                await self.work_item(payload)
+            finally:
+                heartbeat_task.cancel()
+            queue.complete(FETCH, key, owner)
+
+    async def work_item(self, payload):
+        task, args = payload['task'], payload['args']
+        level, path, filename, description = self.entity(task, args)
+
+        # Schools fetched before are polled again, their results are still incomplete
+        if os.path.exists(filename):
+            row = self.state.refresh_row(path)
+            if row is None:
+                # Saved by a crawl without state, compare with the file itself
+                with open(filename) as file:
+                    row = (path, task, args, content_hash(file.read()), None, None)
+            await self.refresh_entity(*row)
+        else:
+            await self.get(task, args, load=False)
+            self.state.checkpoint()
+
+    async def crawl_city(self, city_id):
+        districts_data = await self.get('crawl_city', (city_id,))
+
+        if not districts_data or city_id == YURTDISI_CITY_ID:
+            return
+
+        children_args = [(city_id, district_item['id']) for district_item in districts_data
+                         if self.district_ids is None or district_item['id'] in self.district_ids]
+        self.add_children('crawl_district', children_args)
+        for args in children_args:
+            self.spawn(self.crawl_district(*args))
+
+    async def crawl_district(self, city_id, district_id):
+        if not self.levels & {'neighborhoods', 'schools', 'ballot_boxes'}:
+            return
+
+        neighborhoods_data = await self.get('crawl_district', (city_id, district_id))
+
+        if not neighborhoods_data:
+            return
+
+        children_args = [(city_id, district_id, neighborhood_item['id']) for neighborhood_item in neighborhoods_data]
+        self.add_children('crawl_neighborhood', children_args)
+        for args in children_args:
+            self.spawn(self.crawl_neighborhood(*args))
+
+    async def crawl_neighborhood(self, city_id, district_id, neighborhood_id):
+        if not self.levels & {'schools', 'ballot_boxes'}:
+            return
+
+        schools_data = await self.get('crawl_neighborhood', (city_id, district_id, neighborhood_id))
+
+        if not isinstance(schools_data, list):
+            return
+
+        children_args = [(school_item['id'],) for school_item in schools_data]
+        self.add_children('crawl_school', children_args)
+        for args in children_args:
+            self.spawn(self.crawl_school(*args))
+
+    async def crawl_school(self, school_id):
+        if 'ballot_boxes' not in self.levels:
+            return
+
+        await self.get('crawl_school', (school_id,), load=False)
+        self.state.checkpoint()
+
+
+def main(default_levels=LEVELS):
+    parser = argparse.ArgumentParser(description='Crawl the oyveotesi API hierarchy into JSON files.')
+    parser.add_argument('--levels', nargs='+', choices=LEVELS, default=list(default_levels),
+                        help='Levels to fetch, the others are only read from disk')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Poll the fetched schools whose results may still change and rewrite the changed ones')
+    parser.add_argument('--refresh-all', action='store_true',
+                        help='With --refresh, poll every fetched school')
+    parser.add_argument('--from-queue', nargs='?', const=QUEUE_FILENAME, metavar='QUEUE',
+                        help='Fetch the schools queued by scheduler.py, the most valuable first')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Maximum number of requests in flight')
+    parser.add_argument('--rate', type=float, default=API_LIMITER.rate,
+                        help='Initial requests per second, adjusted to the server while crawling')
+    parser.add_argument('--max-rate', type=float, default=API_LIMITER.max_rate)
+    parser.add_argument('--base-url', default=API_BASE)
+    parser.add_argument('--root', default='.', help='Directory holding cities.json and the output tree')
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.rate > args.max_rate:
+        parser.error('--rate cannot be above --max-rate, the limiter would clamp it')
+
+    API_LIMITER.set_rate(args.rate)
+    API_LIMITER.max_rate = args.max_rate
+    crawler = Crawler(levels=args.levels, concurrency=args.concurrency,
+                      base_url=args.base_url, root=args.root)
+    queue = WorkQueue(args.from_queue) if args.from_queue else None
+    try:
+        with instrumented(args, crawler.progress):
+            asyncio.run(crawler.run(refresh=args.refresh, everything=args.refresh_all, queue=queue))
+    finally:
+        if queue is not None:
+            queue.close()
+
+
+if __name__ == "__main__":
+    main()
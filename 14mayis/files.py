@@ -0,0 +1,41 @@
+import contextlib
+import json
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def temporary_file(directory, suffix='.part'):
+    # A new temporary file in directory, as (file_descriptor, temp_filename). The caller renames it
+    # into place, whatever is left of it is removed, so an interrupted write never leaves a partial file.
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temp_filename = tempfile.mkstemp(dir=directory, suffix=suffix)
+    try:
+        yield file_descriptor, temp_filename
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode='wb', fsync=False):
+    # Write to a temporary file next to filename and rename it into place once complete, so readers
+    # see either the old file or the new one. fsync makes the new content durable before the rename.
+    with temporary_file(os.path.dirname(filename) or '.') as (file_descriptor, temp_filename):
+        with os.fdopen(file_descriptor, mode) as outfile:
+            yield outfile
+            if fsync:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        os.chmod(temp_filename, 0o644)
+        os.replace(temp_filename, filename)
+
+
+def write_text(filename, text):
+    with atomic_write(filename, 'w') as outfile:
+        outfile.write(text)
+
+
+def read_json(filename):
+    with open(filename) as file:
+        return json.load(file)
@@ -0,0 +1,179 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from glob import glob
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from files import temporary_file
+from rate_limiter import RETRY_STATUSES, THROTTLE_STATUSES, AdaptiveRateLimiter, backoff_delay
+
+IMAGES_DIR = 'images'
+CHUNK_SIZE = 64 * 1024
+
+# The image host is separate from the API, so it gets its own limiter
+IMAGE_LIMITER = AdaptiveRateLimiter(rate=20.0)
+
+
+class ImageStore:
+    # Images are stored once under the SHA-256 of their bytes, an index maps every image_url to its hash
+    def __init__(self, root=IMAGES_DIR):
+        self.root = root
+        os.makedirs(os.path.join(root, 'sha256'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(root, 'index.sqlite'), check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            'url TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL, fetched_at REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256)')
+
+    def path(self, digest):
+        return os.path.join(self.root, 'sha256', digest[:2], f'{digest}.jpg')
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.connection.execute('SELECT sha256 FROM images WHERE url = ?', (url,)).fetchone()
+        return row[0] if row else None
+
+    def path_for_url(self, url):
+        digest = self.lookup(url)
+        if digest is None or not os.path.exists(self.path(digest)):
+            return None
+        return self.path(digest)
+
+    def known_urls(self):
+        with self.lock:
+            return {url for url, in self.connection.execute('SELECT url FROM images')}
+
+    def add(self, url, digest, size):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO images (url, sha256, size, fetched_at) VALUES (?, ?, ?, ?)',
+                (url, digest, size, time.time()))
+            self.connection.commit()
+
+    def save_stream(self, chunks):
+        # Stream into a temporary file next to the store and rename it into place once complete,
+        # so a crash never leaves a truncated image under a valid hash
+        sha256 = hashlib.sha256()
+        size = 0
+        with temporary_file(self.root) as (file_descriptor, temp_filename):
+            with os.fdopen(file_descriptor, 'wb') as outfile:
+                for chunk in chunks:
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    outfile.write(chunk)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+
+            digest = sha256.hexdigest()
+            filename = self.path(digest)
+            if os.path.exists(filename):
+                # The same sheet was uploaded again under another URL, the temporary file is dropped
+                return digest, size, False
+
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            os.chmod(temp_filename, 0o644)
+            os.replace(temp_filename, filename)
+            return digest, size, True
+
+    def close(self):
+        self.connection.close()
+
+
+def create_session(workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def download(session, store, url, limiter=IMAGE_LIMITER, max_attempts=5):
+    status = None
+    retry_after = None
+    for attempt in range(max_attempts):
+        if attempt:
+            time.sleep(backoff_delay(attempt - 1, retry_after=retry_after))
+
+        limiter.acquire_sync()
+        started_at = time.monotonic()
+        try:
+            with session.get(url, stream=True, timeout=60) as response:
+                status = response.status_code
+                retry_after = response.headers.get('Retry-After')
+                if status == 200:
+                    digest, size, new = store.save_stream(response.iter_content(CHUNK_SIZE))
+                    limiter.on_success(time.monotonic() - started_at)
+                    store.add(url, digest, size)
+                    return status, digest, size, new
+        except requests.RequestException as error:
+            status = type(error).__name__
+            limiter.on_throttle()
+            continue
+
+        if status in THROTTLE_STATUSES:
+            limiter.on_throttle()
+        elif status not in RETRY_STATUSES:
+            break
+
+    return status, None, 0, False
+
+
+def image_urls(root='.', kinds=('cm',)):
+    # The image_url of every submitted tutanak of the requested kinds, in file order
+    urls = []
+    for filename in glob(os.path.join(root, 'ballot_boxes_in_school', '*.json')):
+        with open(filename) as file:
+            ballot_boxes_in_school_data = json.load(file)
+        for ballot_box in ballot_boxes_in_school_data:
+            for kind in kinds:
+                result = ballot_box.get(f'{kind}_result')
+                if result and result.get('image_url'):
+                    urls.append(result['image_url'])
+    return urls
+
+
+def fetch_images(urls, store, workers=8):
+    known_urls = store.known_urls()
+    pending = list(dict.fromkeys(url for url in urls if url not in known_urls))
+    print(f'{len(pending)} images to download, {len(urls) - len(pending)} already stored')
+
+    downloaded = duplicates = failed = 0
+    session = create_session(workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download, session, store, url): url for url in pending}
+        for future in as_completed(futures):
+            status, digest, size, new = future.result()
+            if digest is None:
+                failed += 1
+                print(f'Error downloading image {futures[future]}: {status}')
+            elif new:
+                downloaded += 1
+            else:
+                duplicates += 1
+
+    print(f'Downloaded {downloaded} images, {duplicates} duplicates of stored images, {failed} failed')
+    return downloaded, duplicates, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download the tutanak images into a content-addressed store.')
+    parser.add_argument('--root', default='.', help='Directory holding ballot_boxes_in_school')
+    parser.add_argument('--kinds', nargs='+', choices=('cm', 'mv'), default=['cm'])
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    store = ImageStore(os.path.join(args.root, IMAGES_DIR))
+    fetch_images(image_urls(args.root, args.kinds), store, args.workers)
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import bisect
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets, from a local mirror up to a throttled API
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+
+class Metrics:
+    # Counters, gauges and histograms keyed by name and labels, shared by the threads and the event
+    # loop of one process. Every update also goes to the JSONL trace when one is open.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.trace_file = None
+
+    def inc(self, name, value=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[label_key(labels)] = value
+
+    def add(self, name, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                # Per bucket counts, the last one for values above every bound, then sum and count
+                histogram = series[key] = [buckets, [0] * (len(buckets) + 1), 0.0, 0]
+            histogram[1][bisect.bisect_left(buckets, value)] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def total(self, name, **labels):
+        # Sum of a counter over every series matching the given labels
+        wanted = set(label_key(labels))
+        with self.lock:
+            return sum(value for key, value in self.counters.get(name, {}).items() if wanted <= set(key))
+
+    def gauge(self, name, **labels):
+        with self.lock:
+            return self.gauges.get(name, {}).get(label_key(labels), 0)
+
+    def by_label(self, name, label):
+        # Counter totals grouped by one label, e.g. requests per status
+        totals = Counter()
+        with self.lock:
+            for key, value in self.counters.get(name, {}).items():
+                totals[dict(key).get(label)] += value
+        return totals
+
+    def open_trace(self, filename):
+        self.trace_file = open(filename, 'a', buffering=1024 * 1024)
+
+    def trace(self, event, **fields):
+        if self.trace_file is None:
+            return
+        line = json.dumps({'ts': round(time.time(), 6), 'event': event, **fields}, default=str)
+        with self.lock:
+            self.trace_file.write(line + '\n')
+
+    def close_trace(self):
+        if self.trace_file is not None:
+            with self.lock:
+                self.trace_file.close()
+                self.trace_file = None
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {name} counter')
+                lines.extend(f'{name}{format_labels(key)} {value}' for key, value in sorted(series.items()))
+            for name, series in sorted(self.gauges.items()):
+                lines.append(f'# TYPE {name} gauge')
+                lines.extend(f'{name}{format_labels(key)} {value}' for key, value in sorted(series.items()))
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for key, (buckets, counts, total, count) in sorted(series.items()):
+                    cumulative = 0
+                    for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(f'{name}_bucket{format_labels(key, [("le", bound)])} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(key)} {total}')
+                    lines.append(f'{name}_count{format_labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def serve(metrics, port, host='127.0.0.1'):
+    # Serve /metrics from a daemon thread, so it works next to an event loop or a thread pool
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+class SamplingProfiler:
+    # Samples the stack of every thread but the metrics' own at a fixed interval and writes them in the
+    # collapsed format of flamegraph.pl and speedscope, one "thread;outer;...;inner count" line per stack
+    def __init__(self, filename, interval=0.01):
+        self.filename = filename
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='metrics-profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if names.get(thread_id, '').startswith('metrics-'):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        with open(self.filename, 'w') as outfile:
+            for stack, count in self.stacks.most_common():
+                outfile.write(f'{stack} {count}\n')
+        print(f'Saved {self.samples} profile samples to {self.filename}')
+
+
+class Reporter:
+    # Prints one progress line every interval instead of a line per item
+    def __init__(self, progress, interval=10.0):
+        self.progress = progress
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='metrics-reporter', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            print(self.progress(), flush=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        print(self.progress(), flush=True)
+
+
+def add_arguments(parser):
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port at /metrics')
+    parser.add_argument('--trace', help='Append a JSONL event per request and OCR call to this file')
+    parser.add_argument('--profile', help='Sample the stacks while running and save them in collapsed format')
+    parser.add_argument('--profile-interval', type=float, default=0.01, help='Seconds between profile samples')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='Seconds between progress lines')
+
+
+@contextlib.contextmanager
+def instrumented(args, progress=None, metrics=METRICS):
+    # Starts what add_arguments' options ask for and stops it again, also when the run fails
+    server = serve(metrics, args.metrics_port) if args.metrics_port else None
+    if args.trace:
+        metrics.open_trace(args.trace)
+    profiler = SamplingProfiler(args.profile, args.profile_interval) if args.profile else None
+    reporter = Reporter(progress, args.progress_interval) if progress else None
+    for worker in (profiler, reporter):
+        if worker is not None:
+            worker.start()
+    try:
+        yield metrics
+    finally:
+        for worker in (reporter, profiler):
+            if worker is not None:
+                worker.stop()
+        metrics.close_trace()
+        if server is not None:
+            server.shutdown()
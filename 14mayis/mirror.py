@@ -0,0 +1,129 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from glob import glob
+
+from aiohttp import web
+
+from aggregate import AGGREGATES_FILENAME, LEVELS, Aggregates
+from crawler import ENTITIES
+
+API_PREFIX = '/api/v1/'
+
+
+def file_pattern(filename_parts):
+    # ('neighborhoods', '{0}', '{1}.json') -> 'neighborhoods/*/*.json'
+    return os.path.join(*[re.sub(r'\{\d\}', '*', part) for part in filename_parts])
+
+
+def load_tree(root='.'):
+    # API path -> (body, ETag) for every file the crawlers saved, read once and served as saved
+    responses = {}
+
+    def add(path, filename):
+        with open(filename, 'rb') as file:
+            body = file.read()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        responses[path] = (body, etag)
+
+    cities_filename = os.path.join(root, 'cities.json')
+    if os.path.exists(cities_filename):
+        add('cities', cities_filename)
+
+    for task, (level, path, filename_parts, description) in ENTITIES.items():
+        depth = len(filename_parts)
+        for filename in glob(os.path.join(root, file_pattern(filename_parts))):
+            parts = os.path.relpath(filename, root).split(os.sep)[-depth:]
+            args = [os.path.splitext(part)[0] for part, pattern in zip(parts, filename_parts) if '{' in pattern]
+            add(path.format(*args), filename)
+    return responses
+
+
+class Mirror:
+    # Serves the saved tree under the API's paths plus the vote aggregates, all from memory.
+    # latency and error_rate make the API paths behave like a loaded server for benchmarks.
+    def __init__(self, responses, aggregates=None, latency=0.0, error_rate=0.0):
+        self.responses = responses
+        self.aggregates = aggregates
+        self.aggregate_bodies = {}
+        self.latency = latency
+        self.error_rate = error_rate
+
+    async def handle_api(self, request):
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.error_rate and random.random() < self.error_rate:
+            return web.Response(status=503)
+
+        response = self.responses.get(request.match_info['path'].strip('/'))
+        if response is None:
+            return web.Response(status=404)
+
+        body, etag = response
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def handle_aggregate(self, request):
+        level = request.match_info['level']
+        if self.aggregates is None or level not in LEVELS:
+            return web.Response(status=404)
+        try:
+            entity_id = int(request.match_info['id'])
+        except ValueError:
+            return web.Response(status=404)
+        if entity_id not in self.aggregates.rows[level]:
+            return web.Response(status=404)
+
+        # The aggregates do not change while serving, each one is serialized on its first request
+        key = (level, entity_id)
+        body = self.aggregate_bodies.get(key)
+        if body is None:
+            body = json.dumps(self.aggregates.totals(level, entity_id)).encode()
+            self.aggregate_bodies[key] = body
+        return web.Response(body=body, content_type='application/json')
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/aggregates/{level}/{id}', self.handle_aggregate)
+        app.router.add_get(API_PREFIX + '{path:.*}', self.handle_api)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the scraped tree and vote aggregates from memory.')
+    parser.add_argument('--root', default='.', help='Directory holding cities.json and the output tree')
+    parser.add_argument('--aggregates', default=AGGREGATES_FILENAME,
+                        help='Saved aggregates, built from the tree when the file does not exist')
+    parser.add_argument('--no-aggregates', action='store_true', help='Only serve the API paths')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Mean seconds added to every API response, varied by +-50%%')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of API requests answered with 503')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    started_at = time.monotonic()
+    responses = load_tree(args.root)
+    if args.no_aggregates:
+        aggregates = None
+    elif os.path.exists(args.aggregates):
+        aggregates = Aggregates.load(args.aggregates)
+    else:
+        aggregates = Aggregates.build(args.root)
+    print(f'Loaded {len(responses)} responses ({sum(len(body) for body, etag in responses.values()) / 1e6:.1f} MB) '
+          f'in {time.monotonic() - started_at:.1f}s')
+    print(f'Serving {API_PREFIX} and /aggregates/{{level}}/{{id}} on http://{args.host}:{args.port}')
+
+    mirror = Mirror(responses, aggregates, args.latency, args.error_rate)
+    web.run_app(mirror.create_app(), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
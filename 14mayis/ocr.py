@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from glob import glob
+
+from metrics import METRICS
+from rate_limiter import TokenBucket
+
+AWS_REGION = 'eu-central-1'
+AWS_PROFILE = 'irensaltali'
+
+
+class OcrProvider:
+    # name is used in reports, tps is the provider's request quota and cost_per_page its list price in USD.
+    # name and features together identify the responses in the OCR cache.
+    name = 'provider'
+    features = ''
+    tps = 1.0
+    cost_per_page = 0.0
+
+    def analyze(self, image_data):
+        raise NotImplementedError
+
+
+class TextractProvider(OcrProvider):
+    name = 'textract'
+    features = 'TABLES'
+    tps = 1.0
+    # AnalyzeDocument with the TABLES feature
+    cost_per_page = 0.015
+
+    def __init__(self, profile_name=AWS_PROFILE, region_name=AWS_REGION):
+        import boto3
+
+        # boto3 clients are thread safe, one client serves every worker
+        session = boto3.Session(profile_name=profile_name, region_name=region_name)
+        self.client = session.client('textract')
+
+    def analyze(self, image_data):
+        return self.client.analyze_document(
+            Document={'Bytes': image_data},
+            FeatureTypes=[
+                'TABLES',
+            ])
+
+
+class VisionProvider(OcrProvider):
+    name = 'vision'
+    features = 'DOCUMENT_TEXT_DETECTION'
+    tps = 10.0
+    # DOCUMENT_TEXT_DETECTION
+    cost_per_page = 0.0015
+
+    def __init__(self):
+        from google.cloud import vision
+
+        self.vision = vision
+        self.client = vision.ImageAnnotatorClient()
+
+    def analyze(self, image_data):
+        response = self.client.document_text_detection(image=self.vision.Image(content=image_data))
+        return self.vision.AnnotateImageResponse.to_dict(response)
+
+
+class FakeProvider(OcrProvider):
+    # Replays saved Textract responses without touching the network. Images with a known response
+    # get it back, any other image gets one of the saved responses picked by its hash.
+    name = 'fake'
+    features = 'TABLES'
+    tps = 1000.0
+    cost_per_page = 0.0
+
+    def __init__(self, responses, latency=0.0):
+        if not responses:
+            raise ValueError('FakeProvider needs at least one saved response')
+        self.responses = responses
+        self.filenames = sorted(set(responses.values()))
+        self.latency = latency
+
+    @classmethod
+    def from_saved(cls, root='.', latency=0.0):
+        return cls(saved_textract_responses(root), latency)
+
+    def analyze(self, image_data):
+        digest = hashlib.sha256(image_data).hexdigest()
+        filename = self.responses.get(digest)
+        if filename is None:
+            filename = self.filenames[int(digest, 16) % len(self.filenames)]
+        if self.latency:
+            time.sleep(self.latency)
+        with open(filename) as file:
+            return json.load(file)
+
+
+def saved_textract_responses(root='.'):
+    # Pair images/{box}/cm.jpg and not_same/{box}/cm.jpg with the textract_data_cm.json saved next to
+    # them by the textract.py before the OCR cache, keyed by the SHA-256 of the image. Both were written
+    # together by that script, later runs write under textract/{school_id}/ which is not matched here.
+    # Responses without their image are kept under their path.
+    responses = {}
+    for textract_data_path in glob(os.path.join(root, '*', '*', 'textract_data_cm.json')):
+        box_dir = os.path.dirname(textract_data_path)
+        ballot_box_number = os.path.basename(box_dir)
+        for image_path in (os.path.join(box_dir, 'cm.jpg'),
+                           os.path.join(root, 'images', ballot_box_number, 'cm.jpg')):
+            if os.path.exists(image_path):
+                with open(image_path, 'rb') as image_file:
+                    responses[hashlib.sha256(image_file.read()).hexdigest()] = textract_data_path
+                break
+        else:
+            responses[f'unpaired:{textract_data_path}'] = textract_data_path
+    return responses
+
+
+class OcrStats:
+    # Calls, bytes, errors, time and estimated cost per provider for one run
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.providers = {}
+
+    def record(self, provider, image_bytes, seconds, error=None):
+        with self.lock:
+            stats = self.providers.setdefault(provider.name, {
+                'calls': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0, 'cost': 0.0})
+            stats['calls'] += 1
+            stats['bytes'] += image_bytes
+            stats['seconds'] += seconds
+            if error is None:
+                stats['cost'] += provider.cost_per_page
+            else:
+                stats['errors'] += 1
+
+    def report(self):
+        for name, stats in sorted(self.providers.items()):
+            print(f'{name}: {stats["calls"]} calls, {stats["errors"]} errors, '
+                  f'{stats["bytes"] / 1e6:.1f} MB uploaded, {stats["seconds"]:.1f}s in calls, '
+                  f'estimated cost ${stats["cost"]:.2f}')
+
+
+# The provider of a worker process, created once by init_worker
+worker_provider = None
+
+
+def init_worker(provider_factory):
+    global worker_provider
+    worker_provider = provider_factory()
+
+
+def analyze_file(provider, image_path):
+    with open(image_path, 'rb') as image_file:
+        image_data = image_file.read()
+
+    started_at = time.monotonic()
+    try:
+        response = provider.analyze(image_data)
+        error = None
+    except Exception as exception:
+        response = None
+        error = f'{type(exception).__name__}: {exception}'
+    return response, len(image_data), time.monotonic() - started_at, error
+
+
+def analyze_in_worker(image_path):
+    return analyze_file(worker_provider, image_path)
+
+
+def record_call(provider, key, image_bytes, seconds, error):
+    METRICS.observe('ocr_call_duration_seconds', seconds, provider=provider.name)
+    METRICS.inc('ocr_calls_total', provider=provider.name, outcome='error' if error else 'ok')
+    METRICS.inc('ocr_uploaded_bytes_total', image_bytes, provider=provider.name)
+    if error is not None:
+        # Errors are counted by exception class, the message is only kept in the trace
+        METRICS.inc('ocr_errors_total', provider=provider.name, error=error.split(':', 1)[0])
+    METRICS.trace('ocr', provider=provider.name, key=key, bytes=image_bytes, seconds=round(seconds, 6),
+                  error=error)
+
+
+def run_ocr(jobs, provider, workers=4, processes=False, provider_factory=None, tps=None, stats=None):
+    # jobs are (key, image_path) pairs; yields (key, response, error) as the calls complete.
+    # Threads share the provider's client. Processes each build their own with provider_factory,
+    # provider may then be the provider class, it is only used for its name, quota and price.
+    stats = stats if stats is not None else OcrStats()
+    bucket = TokenBucket(tps or provider.tps)
+
+    if processes:
+        if provider_factory is None:
+            raise ValueError('A process pool needs a picklable provider_factory')
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(provider_factory,))
+        task, task_args = analyze_in_worker, ()
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        task, task_args = analyze_file, (provider,)
+
+    with executor:
+        in_flight = {}
+        jobs = iter(jobs)
+        while True:
+            # Submissions are paced by the provider's quota and bounded to keep memory flat
+            while len(in_flight) < workers * 2:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                bucket.acquire_sync()
+                key, image_path = job
+                in_flight[executor.submit(task, *task_args, image_path)] = key
+            METRICS.set('ocr_in_flight', len(in_flight), provider=provider.name)
+
+            if not in_flight:
+                break
+
+            done, pending = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = in_flight.pop(future)
+                response, image_bytes, seconds, error = future.result()
+                stats.record(provider, image_bytes, seconds, error)
+                record_call(provider, key, image_bytes, seconds, error)
+                yield key, response, error
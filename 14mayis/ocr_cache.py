@@ -0,0 +1,154 @@
+import argparse
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from files import atomic_write
+from ocr import saved_textract_responses
+
+OCR_CACHE_DIR = 'ocr_cache'
+
+
+def load_response(filename):
+    # Cached responses are gzipped, the legacy textract_data_cm.json files are not
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as file:
+        return json.load(file)
+
+
+class OcrCache:
+    # OCR responses stored once per image, provider and feature set, under the SHA-256 of the image.
+    # An index records their sizes and last use for eviction.
+    def __init__(self, root=OCR_CACHE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(root, 'index.sqlite'), check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'sha256 TEXT NOT NULL, provider TEXT NOT NULL, features TEXT NOT NULL, size INTEGER NOT NULL, '
+            'created_at REAL NOT NULL, used_at REAL NOT NULL, PRIMARY KEY (sha256, provider, features))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS imports ('
+            'root TEXT NOT NULL, provider TEXT NOT NULL, features TEXT NOT NULL, imported INTEGER NOT NULL, '
+            'imported_at REAL NOT NULL, PRIMARY KEY (root, provider, features))')
+
+    def path(self, digest, provider, features):
+        return os.path.join(self.root, provider, features, digest[:2], f'{digest}.json.gz')
+
+    def get(self, digest, provider, features):
+        filename = self.path(digest, provider, features)
+        try:
+            response = load_response(filename)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.connection.execute(
+                'UPDATE responses SET used_at = ? WHERE sha256 = ? AND provider = ? AND features = ?',
+                (time.time(), digest, provider, features))
+            self.connection.commit()
+        return response
+
+    def put(self, digest, provider, features, response):
+        # Written to a temporary file and renamed into place, a crash never leaves a partial response
+        filename = self.path(digest, provider, features)
+        with atomic_write(filename) as outfile:
+            with gzip.GzipFile(fileobj=outfile, mode='wb', mtime=0) as gzip_file:
+                gzip_file.write(json.dumps(response).encode())
+
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (sha256, provider, features, size, created_at, used_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (digest, provider, features, os.path.getsize(filename), now, now))
+            self.connection.commit()
+
+    def paths(self, provider):
+        # The cached response of every image for one provider, the most recent feature set wins
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT sha256, features FROM responses WHERE provider = ? ORDER BY created_at',
+                (provider,)).fetchall()
+        return {digest: self.path(digest, provider, features) for digest, features in rows}
+
+    def total_size(self):
+        with self.lock:
+            return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def evict(self, max_bytes):
+        # Drop the least recently used responses until the cache fits in max_bytes
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT sha256, provider, features, size FROM responses ORDER BY used_at DESC').fetchall()
+            kept = 0
+            evicted = []
+            for digest, provider, features, size in rows:
+                if kept + size <= max_bytes:
+                    kept += size
+                else:
+                    evicted.append((digest, provider, features))
+
+            for digest, provider, features in evicted:
+                filename = self.path(digest, provider, features)
+                if os.path.exists(filename):
+                    os.remove(filename)
+            self.connection.executemany(
+                'DELETE FROM responses WHERE sha256 = ? AND provider = ? AND features = ?', evicted)
+            self.connection.commit()
+        return len(evicted)
+
+    def import_saved(self, root='.', provider='textract', features='TABLES'):
+        # Copy the responses saved next to the images by earlier runs, those whose image is unknown are skipped
+        imported = 0
+        for digest, textract_data_path in saved_textract_responses(root).items():
+            if digest.startswith('unpaired:') or os.path.exists(self.path(digest, provider, features)):
+                continue
+            self.put(digest, provider, features, load_response(textract_data_path))
+            imported += 1
+        return imported
+
+    def import_saved_once(self, root='.', provider='textract', features='TABLES'):
+        # Only the textract.py before the cache wrote these files, importing them before the first run
+        # that uses the cache is enough. Returns None when they were imported before.
+        key = (os.path.abspath(root), provider, features)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT imported FROM imports WHERE root = ? AND provider = ? AND features = ?', key).fetchone()
+        if row is not None:
+            return None
+        imported = self.import_saved(root, provider, features)
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO imports (root, provider, features, imported, imported_at) '
+                'VALUES (?, ?, ?, ?, ?)', (*key, imported, time.time()))
+            self.connection.commit()
+        return imported
+
+    def close(self):
+        self.connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the OCR response cache.')
+    parser.add_argument('--root', default='.', help='Directory holding the ocr_cache')
+    parser.add_argument('--import-saved', action='store_true',
+                        help='Import the textract_data_cm.json files saved under textract/ and not_same/')
+    parser.add_argument('--max-size', type=float, help='Evict least recently used responses above this many MB')
+    args = parser.parse_args()
+
+    cache = OcrCache(os.path.join(args.root, OCR_CACHE_DIR))
+    if args.import_saved:
+        print(f'Imported {cache.import_saved(args.root)} saved Textract responses')
+    if args.max_size is not None:
+        print(f'Evicted {cache.evict(int(args.max_size * 1e6))} responses')
+    print(f'The cache holds {cache.total_size() / 1e6:.1f} MB of responses')
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+from files import atomic_write
+from images import IMAGES_DIR, ImageStore
+
+PREPROCESSED_DIR = 'preprocessed'
+
+# Skew is searched in this range of degrees on a downscaled copy of the sheet
+MAX_SKEW = 5.0
+SKEW_STEP = 0.25
+SKEW_SEARCH_WIDTH = 600
+
+# A row or column belongs to the sheet when this share of its pixels is bright
+SHEET_DENSITY = 0.5
+CROP_MARGIN = 0.02
+# Crops keeping less of the photo than this are treated as a failed sheet detection
+MIN_CROP_AREA = 0.2
+
+# Binary sheets compare each pixel with the mean of its neighbourhood, a global threshold loses
+# the half of the sheet that is in shadow. Ink is darker than its surroundings by this many levels.
+BINARY_WINDOW = 1 / 40
+BINARY_OFFSET = 12
+
+# Textract reads the printed names and handwritten digits well below this resolution
+MAX_SIDE = 1600
+JPEG_QUALITY = 70
+
+# Output file extension of each variant, binary sheets compress far better as 1-bit PNG
+VARIANTS = {'gray': 'jpg', 'binary': 'png'}
+
+
+def otsu_threshold(pixels):
+    histogram = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_dark = np.cumsum(histogram)
+    weight_light = weight_dark[-1] - weight_dark
+    sum_dark = np.cumsum(histogram * levels)
+    mean_dark = sum_dark / np.maximum(weight_dark, 1)
+    mean_light = (sum_dark[-1] - sum_dark) / np.maximum(weight_light, 1)
+    between = weight_dark * weight_light * (mean_dark - mean_light) ** 2
+    return int(np.argmax(between))
+
+
+def find_skew(image):
+    # The table rules give sharp peaks in the row sums of the dark pixels when the sheet is level,
+    # so the best angle is the one with the largest variance of the row sums
+    scale = SKEW_SEARCH_WIDTH / image.width
+    small = image.resize((SKEW_SEARCH_WIDTH, max(1, int(image.height * scale))))
+    pixels = np.asarray(small)
+    dark = Image.fromarray(((pixels < otsu_threshold(pixels)) * 255).astype(np.uint8))
+
+    best_angle = 0.0
+    best_score = None
+    for angle in np.arange(-MAX_SKEW, MAX_SKEW + SKEW_STEP / 2, SKEW_STEP):
+        rows = np.asarray(dark.rotate(angle, resample=Image.NEAREST)).sum(axis=1, dtype=np.float64)
+        score = rows.var()
+        if best_score is None or score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def bright_span(density):
+    bright = np.flatnonzero(density > SHEET_DENSITY)
+    if len(bright) < 2:
+        return None
+    return bright[0], bright[-1] + 1
+
+
+def find_sheet(pixels):
+    # The tutanaks are photographed on desks and floors, the paper is the bright region and its
+    # tables cover nearly all of it, so the crop keeps the rows and columns that are mostly paper
+    bright = pixels >= otsu_threshold(pixels)
+    height, width = bright.shape
+
+    rows = bright_span(bright.mean(axis=1))
+    if rows is None:
+        return None
+    columns = bright_span(bright[rows[0]:rows[1]].mean(axis=0))
+    if columns is None:
+        return None
+
+    margin = int(max(height, width) * CROP_MARGIN)
+    top, bottom = max(0, rows[0] - margin), min(height, rows[1] + margin)
+    left, right = max(0, columns[0] - margin), min(width, columns[1] + margin)
+    if (bottom - top) * (right - left) < MIN_CROP_AREA * height * width:
+        return None
+    return left, top, right, bottom
+
+
+def binarize(image):
+    radius = max(4, int(max(image.size) * BINARY_WINDOW))
+    pixels = np.asarray(image, dtype=np.int16)
+    background = np.asarray(image.filter(ImageFilter.BoxBlur(radius)), dtype=np.int16)
+    return Image.fromarray(pixels >= background - BINARY_OFFSET)
+
+
+def preprocess_image(image, variant='gray'):
+    image = ImageOps.exif_transpose(image).convert('L')
+    if max(image.size) > MAX_SIDE:
+        image.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+
+    # Crop before deskewing so the ink on the paper, not the background, decides the angle
+    box = find_sheet(np.asarray(image))
+    if box is not None:
+        image = image.crop(box)
+
+    angle = find_skew(image)
+    if angle:
+        image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+
+    if variant == 'binary':
+        return binarize(image)
+    return ImageOps.autocontrast(image, cutoff=1)
+
+
+def preprocessed_path(store_root, digest, variant='gray'):
+    # Keyed by the hash of the source image, so every stored image is processed at most once per variant
+    return os.path.join(store_root, PREPROCESSED_DIR, variant, digest[:2], f'{digest}.{VARIANTS[variant]}')
+
+
+def preprocess_file(source_path, output_path, variant='gray'):
+    with Image.open(source_path) as image:
+        processed = preprocess_image(image, variant)
+
+    with atomic_write(output_path) as outfile:
+        if variant == 'binary':
+            processed.save(outfile, format='PNG', optimize=True)
+        else:
+            processed.save(outfile, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    return os.path.getsize(source_path), os.path.getsize(output_path)
+
+
+def preprocess_job(job):
+    source_path, output_path, variant = job
+    try:
+        return source_path, preprocess_file(source_path, output_path, variant), None
+    except Exception as exception:
+        return source_path, None, f'{type(exception).__name__}: {exception}'
+
+
+def preprocess_store(store_root=IMAGES_DIR, digests=None, variant='gray', workers=None):
+    # Process the stored images without a cached output, all of them unless digests are given.
+    # Returns the preprocessed path of every image that has one.
+    if digests is None:
+        digests = [os.path.splitext(os.path.basename(filename))[0]
+                   for filename in glob(os.path.join(store_root, 'sha256', '*', '*.jpg'))]
+
+    paths = {}
+    jobs = []
+    for digest in dict.fromkeys(digests):
+        output_path = preprocessed_path(store_root, digest, variant)
+        paths[digest] = output_path
+        if not os.path.exists(output_path):
+            jobs.append((os.path.join(store_root, 'sha256', digest[:2], f'{digest}.jpg'), output_path, variant))
+    print(f'{len(jobs)} images to preprocess, {len(paths) - len(jobs)} already cached')
+
+    source_bytes = output_bytes = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for source_path, sizes, error in executor.map(preprocess_job, jobs, chunksize=8):
+            if error is not None:
+                failed += 1
+                digest = os.path.splitext(os.path.basename(source_path))[0]
+                del paths[digest]
+                print(f'Error preprocessing {source_path}: {error}')
+                continue
+            source_bytes += sizes[0]
+            output_bytes += sizes[1]
+
+    if jobs:
+        print(f'Preprocessed {len(jobs) - failed} images, {failed} failed, '
+              f'{source_bytes / 1e6:.1f} MB -> {output_bytes / 1e6:.1f} MB')
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deskew, crop and recompress the stored tutanak images for OCR.')
+    parser.add_argument('--root', default='.', help='Directory holding the images store')
+    parser.add_argument('--variant', choices=sorted(VARIANTS), default='gray',
+                        help='gray keeps grayscale levels, binary thresholds the sheet to black and white')
+    parser.add_argument('--workers', type=int, help='Worker processes, all CPU cores by default')
+    args = parser.parse_args()
+
+    # Opening the store creates it and its index if they do not exist yet
+    ImageStore(os.path.join(args.root, IMAGES_DIR)).close()
+    preprocess_store(os.path.join(args.root, IMAGES_DIR), variant=args.variant, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
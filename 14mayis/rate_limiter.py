@@ -0,0 +1,130 @@
+import asyncio
+import random
+import threading
+import time
+
+# Responses worth retrying, and the subset that means the server wants us to slow down
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, rate))
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        # Take one token if there is one, otherwise return how long until the next one is due.
+        # Callers never go into debt, so a rate change applies to everyone still waiting.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def set_rate(self, rate):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.rate = rate
+
+    async def acquire(self):
+        delay = self.take()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.take()
+
+    def acquire_sync(self):
+        delay = self.take()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.take()
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    # Additive increase / multiplicative decrease around the highest rate the server tolerates
+    def __init__(self, rate=10.0, min_rate=0.5, max_rate=100.0, burst=None,
+                 latency_tolerance=2.0, latency_slack=0.05, baseline_decay=0.005, decrease_factor=0.5,
+                 decrease_interval=1.0):
+        super().__init__(rate, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.latency_tolerance = latency_tolerance
+        self.latency_slack = latency_slack
+        self.baseline_decay = baseline_decay
+        self.decrease_factor = decrease_factor
+        self.decrease_interval = decrease_interval
+        self.decreased_at = 0.0
+        # endpoint -> [baseline latency, moving average latency], endpoints differ in how fast they answer
+        self.latencies = {}
+
+    def on_success(self, latency, endpoint=None):
+        # The baseline follows the fastest recent latencies: it drops to any faster response at once and
+        # creeps up towards slower ones, so one lucky response does not set the bar for the rest of the run
+        latencies = self.latencies.get(endpoint)
+        if latencies is None:
+            latencies = self.latencies[endpoint] = [latency, latency]
+        baseline_latency, average_latency = latencies
+        if latency < baseline_latency:
+            baseline_latency = latency
+        else:
+            baseline_latency += self.baseline_decay * (latency - baseline_latency)
+        average_latency = 0.9 * average_latency + 0.1 * latency
+        latencies[:] = [baseline_latency, average_latency]
+
+        # Small absolute differences are noise, so the slack keeps fast servers from looking overloaded
+        slow_latency = max(baseline_latency * self.latency_tolerance, baseline_latency + self.latency_slack)
+        if average_latency > slow_latency:
+            # The server is queueing our requests, back off gently, once per interval like on_throttle
+            now = time.monotonic()
+            if now - self.decreased_at >= self.decrease_interval:
+                self.decreased_at = now
+                self.set_rate(max(self.min_rate, self.rate * 0.95))
+        else:
+            # Grow by roughly one request per second for every second of healthy responses
+            self.set_rate(min(self.max_rate, self.rate + 1.0 / self.rate))
+
+    def on_throttle(self):
+        # Requests in flight together tend to fail together, so only back off once per interval
+        now = time.monotonic()
+        if now - self.decreased_at < self.decrease_interval:
+            return
+        self.decreased_at = now
+        self.set_rate(max(self.min_rate, self.rate * self.decrease_factor))
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, retry_after=None):
+    # Exponential backoff with full jitter, honouring the server's Retry-After when it sends one
+    if retry_after is not None:
+        try:
+            return min(cap, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RetryQueue:
+    # Requests that still failed after every retry, crawl_state.py records them across runs
+    def __init__(self):
+        self.items = []
+
+    def push(self, task, args, status):
+        self.items.append({'task': task, 'args': list(args), 'status': status, 'failed_at': time.time()})
+
+    def drain(self):
+        items, self.items = self.items, []
+        return items
+
+    def __len__(self):
+        return len(self.items)
+
+
+# Every script talking to api-sonuc.oyveotesi.org in this process shares one limiter
+API_LIMITER = AdaptiveRateLimiter()
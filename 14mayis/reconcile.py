@@ -0,0 +1,159 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+from candidates import TOTAL, VOTE_KEYS, get_vote_counts
+from images import IMAGES_DIR
+from ocr import TextractProvider, saved_textract_responses
+from ocr_cache import OCR_CACHE_DIR, OcrCache, load_response
+from textract_tables import extract_tables
+
+REPORT_FILENAME = 'reconciliation.csv'
+
+# Lookups shared by the worker processes, set once by init_worker
+worker_image_hashes = None
+worker_responses = None
+
+
+def load_image_hashes(root='.'):
+    # image_url -> SHA-256 of the image, as recorded by images.py
+    index_filename = os.path.join(root, IMAGES_DIR, 'index.sqlite')
+    if not os.path.exists(index_filename):
+        return {}
+    connection = sqlite3.connect(index_filename)
+    try:
+        return dict(connection.execute('SELECT url, sha256 FROM images'))
+    finally:
+        connection.close()
+
+
+def load_response_paths(root='.'):
+    # Image SHA-256 -> Textract response, the cached responses win over the files saved by older runs
+    responses = saved_textract_responses(root)
+    cache_root = os.path.join(root, OCR_CACHE_DIR)
+    if os.path.exists(os.path.join(cache_root, 'index.sqlite')):
+        ocr_cache = OcrCache(cache_root)
+        responses.update(ocr_cache.paths(TextractProvider.name))
+        ocr_cache.close()
+    return responses
+
+
+def init_worker(image_hashes, responses):
+    global worker_image_hashes, worker_responses
+    worker_image_hashes = image_hashes
+    worker_responses = responses
+
+
+def compare(school_id, ballot_box, ocr_counts):
+    cm_result = ballot_box['cm_result']
+    api_votes = cm_result.get('votes', {})
+    row = {
+        'school_id': school_id,
+        'ballot_box_number': ballot_box.get('ballot_box_number'),
+        'image_url': cm_result.get('image_url'),
+    }
+
+    # Candidates missing from the API votes got no votes, candidates OCR could not read are left empty
+    score = 0
+    unread = 0
+    for vote_key, candidate in VOTE_KEYS.items():
+        api_count = api_votes.get(vote_key, 0)
+        ocr_count = ocr_counts.get(candidate)
+        row[f'api_{vote_key}'] = api_count
+        row[f'ocr_{vote_key}'] = ocr_count
+        if ocr_count is None:
+            unread += 1
+        else:
+            score += abs(ocr_count - api_count)
+
+    api_total = cm_result.get('total_vote')
+    ocr_total = ocr_counts.get(TOTAL)
+    row['api_total'] = api_total
+    row['ocr_total'] = ocr_total
+    if api_total is not None and ocr_total is not None:
+        score += abs(ocr_total - api_total)
+
+    # A sheet whose candidates add up to its own TOPLAM was read reliably, so a difference from
+    # the API is a difference between the sheet and the submission and not an OCR error
+    candidate_sum = sum(ocr_counts.get(candidate, 0) for candidate in VOTE_KEYS.values())
+    row['ocr_consistent'] = unread == 0 and ocr_total == candidate_sum
+    row['unread'] = unread
+    row['score'] = score
+    return row
+
+
+def reconcile_file(filename):
+    school_id = int(os.path.splitext(os.path.basename(filename))[0])
+    with open(filename) as file:
+        ballot_boxes_in_school_data = json.load(file)
+
+    rows = []
+    missing = 0
+    for ballot_box in ballot_boxes_in_school_data:
+        cm_result = ballot_box.get('cm_result')
+        if not cm_result or not cm_result.get('image_url'):
+            continue
+
+        digest = worker_image_hashes.get(cm_result['image_url'])
+        textract_data_path = worker_responses.get(digest) if digest else None
+        if textract_data_path is None:
+            missing += 1
+            continue
+
+        response = load_response(textract_data_path)
+        rows.append(compare(school_id, ballot_box, get_vote_counts(extract_tables(response))))
+    return rows, missing
+
+
+def reconcile(root='.', workers=None):
+    image_hashes = load_image_hashes(root)
+    responses = load_response_paths(root)
+    filenames = glob(os.path.join(root, 'ballot_boxes_in_school', '*.json'))
+
+    rows = []
+    missing = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(image_hashes, responses)) as executor:
+        for file_rows, file_missing in executor.map(reconcile_file, filenames, chunksize=64):
+            rows.extend(file_rows)
+            missing += file_missing
+
+    # Self-consistent sheets that disagree with the API first, then by size of the difference
+    rows.sort(key=lambda row: (not row['ocr_consistent'], -row['score']))
+    return rows, missing
+
+
+def write_report(rows, filename=REPORT_FILENAME):
+    fieldnames = ['score', 'ocr_consistent', 'unread', 'school_id', 'ballot_box_number']
+    for vote_key in VOTE_KEYS:
+        fieldnames += [f'api_{vote_key}', f'ocr_{vote_key}']
+    fieldnames += ['api_total', 'ocr_total', 'image_url']
+
+    with open(filename, 'w', newline='') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the OCR vote counts with the votes reported by the API.')
+    parser.add_argument('--root', default='.', help='Directory holding ballot_boxes_in_school, images and textract')
+    parser.add_argument('--workers', type=int, help='Worker processes, all CPU cores by default')
+    parser.add_argument('--output', default=REPORT_FILENAME)
+    args = parser.parse_args()
+
+    rows, missing = reconcile(args.root, args.workers)
+    different = [row for row in rows if row['score'] > 0 or row['unread']]
+    write_report(different, args.output)
+
+    print(f'Compared {len(rows)} ballot boxes, {len(rows) - len(different)} match the API, '
+          f'{len(different)} differ, {missing} without OCR data yet')
+    print(f'Saved the discrepancy report to {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import os
+import time
+from glob import glob
+
+import numpy as np
+
+from aggregate import COLUMN_INDEX, Aggregates
+from compact import file_id
+from crawler import ENTITIES
+from files import read_json
+from ocr import TextractProvider
+from ocr_cache import OCR_CACHE_DIR, OcrCache
+from reconcile import load_image_hashes
+from work_queue import FETCH, OCR, QUEUE_FILENAME, WorkQueue
+
+# The two leading candidates in cm_result votes, a close race between them makes a district's
+# ballot boxes worth more
+LEADING_CANDIDATES = ('1', '3')
+
+# Weights of the priority terms, every term is between 0 and 1
+COVERAGE_WEIGHT = 2.0
+DISTRICT_SIZE_WEIGHT = 1.0
+CLOSENESS_WEIGHT = 1.0
+DISCREPANCY_WEIGHT = 2.0
+VOTES_WEIGHT = 1.0
+
+# The planned priorities stay below this, watcher.py queues fresh uploads above it
+FRESH_PRIORITY = 10.0
+
+
+def district_values(aggregates):
+    # Per school row: how large and how close its district is, weighted and summed
+    school_districts = aggregates.parents['neighborhood'][aggregates.parents['school']]
+    district_schools = np.bincount(school_districts, minlength=len(aggregates.ids['district']))
+    size = district_schools / max(district_schools.max(), 1)
+
+    counts = aggregates.counts['district'].astype(np.float64)
+    first, second = (counts[:, COLUMN_INDEX[f'cm_votes_{candidate_id}']] for candidate_id in LEADING_CANDIDATES)
+    total = counts[:, COLUMN_INDEX['cm_total_vote']]
+    # Districts without any votes yet count as half close
+    margin = np.divide(np.abs(first - second), total, out=np.full_like(total, 0.5), where=total > 0)
+    closeness = 1 - np.clip(margin, 0, 1)
+
+    district_value = DISTRICT_SIZE_WEIGHT * size + CLOSENESS_WEIGHT * closeness
+    return district_value[school_districts]
+
+
+def coverage_gaps(aggregates, fetched):
+    # Per school row: 1 for a school never fetched, else the share of its results still missing
+    counts = aggregates.counts['school']
+    ballot_boxes = counts[:, COLUMN_INDEX['ballot_boxes']].astype(np.float64)
+    results = (counts[:, COLUMN_INDEX['cm_boxes']] + counts[:, COLUMN_INDEX['mv_boxes']]).astype(np.float64)
+    gaps = np.divide(2 * ballot_boxes - results, 2 * ballot_boxes, out=np.zeros_like(ballot_boxes),
+                     where=ballot_boxes > 0)
+    gaps[~np.isin(aggregates.ids['school'], list(fetched))] = 1.0
+    return gaps
+
+
+def plan_fetches(aggregates, fetched, values):
+    level, path, filename_parts, description = ENTITIES['crawl_school']
+    gaps = coverage_gaps(aggregates, fetched)
+    priorities = COVERAGE_WEIGHT * gaps + values
+    items = []
+    for row in np.flatnonzero(gaps > 0):
+        school_id = int(aggregates.ids['school'][row])
+        items.append((path.format(school_id), float(priorities[row]),
+                      {'task': 'crawl_school', 'args': [school_id]}))
+    return items
+
+
+def plan_ocr(root, aggregates, values):
+    # The cm images without a cached Textract response, keyed by URL as one image can be shared
+    image_hashes = load_image_hashes(root)
+    cache_root = os.path.join(root, OCR_CACHE_DIR)
+    cached = set()
+    if os.path.exists(os.path.join(cache_root, 'index.sqlite')):
+        ocr_cache = OcrCache(cache_root)
+        cached = set(ocr_cache.paths(TextractProvider.name))
+        ocr_cache.close()
+
+    ballot_boxes = []
+    for filename in glob(os.path.join(root, 'ballot_boxes_in_school', '*.json')):
+        school_id = file_id(filename)
+        row = aggregates.rows['school'].get(school_id)
+        if row is None:
+            continue
+        for ballot_box in read_json(filename):
+            cm_result = ballot_box.get('cm_result')
+            image_url = cm_result.get('image_url') if cm_result else None
+            if not image_url or image_hashes.get(image_url) in cached:
+                continue
+            total_vote = cm_result.get('total_vote') or 0
+            # Votes that do not add up to the reported total are worth checking against the tutanak first
+            discrepancy = sum((cm_result.get('votes') or {}).values()) != total_vote
+            ballot_boxes.append((image_url, row, total_vote, discrepancy,
+                                 {'school_id': school_id, 'ballot_box_number': ballot_box.get('ballot_box_number'),
+                                  'image_url': image_url}))
+
+    max_total_vote = max([total_vote for _, _, total_vote, _, _ in ballot_boxes], default=0) or 1
+    return [(image_url, DISCREPANCY_WEIGHT * discrepancy + VOTES_WEIGHT * total_vote / max_total_vote
+             + float(values[row]), payload)
+            for image_url, row, total_vote, discrepancy, payload in ballot_boxes]
+
+
+def plan(root, queue):
+    started_at = time.time()
+    aggregates = Aggregates.build(root)
+    values = district_values(aggregates)
+    fetched = {file_id(filename) for filename in glob(os.path.join(root, 'ballot_boxes_in_school', '*.json'))}
+
+    fetch_items = plan_fetches(aggregates, fetched, values)
+    ocr_items = plan_ocr(root, aggregates, values)
+    queue.push(FETCH, fetch_items)
+    # Fresh uploads queued by watcher.py stay ahead of the planned work
+    queue.push(OCR, ocr_items, keep_above=FRESH_PRIORITY)
+    retired = queue.retire(FETCH, started_at) + queue.retire(OCR, started_at)
+    print(f'Queued {len(fetch_items)} schools to fetch and {len(ocr_items)} images to OCR, '
+          f'{retired} items no longer needed, in {time.time() - started_at:.1f}s')
+
+
+def print_counts(queue):
+    for kind, status, count, max_priority in queue.counts():
+        print(f'{kind:<6} {status:<8} {count:>8}  top priority {max_priority:.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Queue the fetch and OCR work, the most valuable ballot boxes first. '
+                    'crawler.py and textract.py work through it with --from-queue.')
+    parser.add_argument('--root', default='.', help='Directory holding the scraped JSON tree, images and OCR cache')
+    parser.add_argument('--queue', default=QUEUE_FILENAME)
+    parser.add_argument('--interval', type=float,
+                        help='Plan again every this many seconds, so new results and responses reorder the queue')
+    parser.add_argument('--status', action='store_true', help='Only print the queue counts')
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    try:
+        while not args.status:
+            plan(args.root, queue)
+            print_counts(queue)
+            if not args.interval:
+                return
+            time.sleep(args.interval)
+        print_counts(queue)
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
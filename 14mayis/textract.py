@@ -1,148 +1,33 @@
+import argparse
+import functools
 import json
 import os
-import requests
-import boto3
+import shutil
 import time
-import re
-from google.cloud import vision
-from google.oauth2 import service_account
+
+from candidates import TOTAL, get_vote_counts
+from images import ImageStore, create_session, download
+from metrics import METRICS, add_arguments, instrumented
+from ocr import FakeProvider, OcrStats, TextractProvider, VisionProvider, run_ocr
+from ocr_cache import OcrCache
+from preprocess import VARIANTS, preprocess_store
+from textract_tables import extract_tables, tables_to_csv
+from work_queue import OCR, QUEUE_FILENAME, WorkQueue, default_owner, keep_leased
 
 # Configure AWS credentials and region for Textract
-AWS_REGION = 'eu-central-1'
 S3_BUCKET = 'xx'
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = './credentials.json'
 
-def get_rows_columns_map(table_result, blocks_map):
-    rows = {}
-    for relationship in table_result['Relationships']:
-        if relationship['Type'] == 'CHILD':
-            for child_id in relationship['Ids']:
-                cell = blocks_map[child_id]
-                if cell['BlockType'] == 'CELL':
-                    row_index = cell['RowIndex']
-                    col_index = cell['ColumnIndex']
-                    if row_index not in rows:
-                        # create new row
-                        rows[row_index] = {}
-
-                    # get the text value
-                    rows[row_index][col_index] = get_text(cell, blocks_map)
-    return rows
-
-
-def get_text(result, blocks_map):
-    text = ''
-    if 'Relationships' in result:
-        for relationship in result['Relationships']:
-            if relationship['Type'] == 'CHILD':
-                for child_id in relationship['Ids']:
-                    word = blocks_map[child_id]
-                    if word['BlockType'] == 'WORD':
-                        text += word['Text'] + ' '
-                    if word['BlockType'] == 'SELECTION_ELEMENT':
-                        if word['SelectionStatus'] == 'SELECTED':
-                            text += 'X '
-    return text
-
-
-def generate_table_csv(table_result, blocks_map, table_index):
-    rows = get_rows_columns_map(table_result, blocks_map)
-
-    table_id = 'Table_' + str(table_index)
-
-    # get cells.
-    csv = 'Table: {0}\n\n'.format(table_id)
-
-    for row_index, cols in rows.items():
-
-        for col_index, text in cols.items():
-            csv += '{}'.format(text) + ","
-        csv += '\n'
-
-    csv += '\n\n\n'
-    return csv
-
-
-def get_vote_count_from_textract(data):
-    # Define the candidate names to extract vote counts for
-    candidates = {
-        "RECEP TAYYIP ERDOGAN": ["RECEP TAYYIP ERDOGAN", "RECEP TAYYP ERDOGAN", "RECEP TAYYIP ERD0GAN", "RECEP TAYYP ERD0GAN", "RECEP TAYYIP ERD0GAN"],
-        "MUHARREM INCE": ["MUHARREM INCE", "MUHARREM 1NCE", "MUHAREM INCE", "MUHARREM INÇE"],
-        "KEMAL KILICDAROGLU": ["KEMAL KILICDAROGLU", "KEMAL KILICOAROGLU", "KEMAL K1LICDAROGLU", "KEMA_ KILICDAROGLU", "KEMAL KILICDAR0GLU", "KEMA_ K1LICDAR0GLU"],
-        "SINAN OGAN": ["SINAN OGAN", "SINAN 0GAN", "S1NAN OGAN", "SINAN OG_N", "S1NAN 0G_N", "SNAN 0GAN"]
-    }
-
-    # Initialize an empty dictionary to store the vote counts
-    vote_counts = {}
-
-    # Extract the numbers for each candidate and their typos
-    for candidate, typos in candidates.items():
-        for typo in typos:
-            # Use regular expressions to find the numbers after the candidate's name or typo
-            pattern = re.compile(f"{typo}\s*,\s*(\d+)")
-            match = pattern.search(data)
-
-            if match:
-                # Extract the vote count
-                vote_count = int(match.group(1))
-                # If candidate already has a vote count, add this count to the existing value
-                if candidate in vote_counts:
-                    vote_counts[candidate] += vote_count
-                # Otherwise, store the vote count in the dictionary
-                else:
-                    vote_counts[candidate] = vote_count
-                # Since a match is found, proceed to the next candidate/typo
-                break
-
-    # Extract the total vote count
-    pattern = re.compile("TOPLAM\s*,\s*(\d+)")
-    match = pattern.search(data)
-
-    if match:
-        total_votes = int(match.group(1))
-        # Store the total vote count in the dictionary
-        vote_counts["TOPLAM"] = total_votes
-
-    return vote_counts
-
-
-def textract_to_csv(response):
-    blocks = response['Blocks']
-    blocks_map = {}
-    table_blocks = []
-    for block in blocks:
-        blocks_map[block['Id']] = block
-        if block['BlockType'] == "TABLE":
-            table_blocks.append(block)
-
-    if len(table_blocks) <= 0:
-        print("<b> NO Table FOUND </b>")
-
-    csv = ''
-    for index, table in enumerate(table_blocks):
-        csv += generate_table_csv(table, blocks_map, index + 1)
-
-    csv = re.sub(r'[^A-Za-z0-9, ]', '', csv)
-
-    return csv
-
-def main():
-    # Create directories for images and Textract data
-    os.makedirs('images', exist_ok=True)
-    os.makedirs('textract', exist_ok=True)
-    os.makedirs('not_same', exist_ok=True)
-
-    # Create a session for AWS Textract and S3
-    session = boto3.Session(
-        profile_name='irensaltali',
-        region_name=AWS_REGION
-    )
-    textract_client = session.client('textract')
+def collect_ballot_boxes(image_store, image_session):
+    # The ballot boxes with a cm image, as (school_id, ballot_box_number, local_image_path) tuples.
+    # Ballot box numbers repeat across schools, only the pair identifies a ballot box.
+    ballot_boxes = []
 
     # Iterate over each ballot box data file
     for filename in os.listdir('ballot_boxes_in_school'):
-        print(f'Processing {filename}...')
+        METRICS.inc('textract_school_files_total')
         file_path = f'ballot_boxes_in_school/{filename}'
+        school_id = os.path.splitext(filename)[0]
 
         with open(file_path) as file:
             ballot_boxes_in_school_data = json.load(file)
@@ -150,119 +35,300 @@ def main():
         for ballot_box in ballot_boxes_in_school_data:
             cm_result = ballot_box.get('cm_result')
             ballot_box_number = ballot_box.get('ballot_box_number')
-            print(f'Processing ballot box {ballot_box_number}...')
 
             # Skip if cm_result is None
             if cm_result is None:
-                print(
-                    f'Skipping ballot box {ballot_box_number}: cm_result is None')
+                METRICS.inc('textract_skipped_total', reason='no_cm_result')
                 continue
 
             image_url = cm_result.get('image_url', '')
 
             # Skip if image_url is empty
             if not image_url:
-                print(
-                    f'Skipping ballot box {ballot_box_number}: image_url is empty')
+                METRICS.inc('textract_skipped_total', reason='no_image_url')
                 continue
-            else:
-                # Check if image already exists in local folder before uploading
-                local_image_path = os.path.join(
-                    '.', f'images/{ballot_box_number}/cm.jpg')
-                if not os.path.exists(local_image_path):
-                    # Image doesn't exist in local folder, proceed with download and save
-                    response = requests.get(image_url)
-                    if response.status_code == 200:
-                        os.makedirs(os.path.dirname(local_image_path), exist_ok=True)
-                        with open(local_image_path, 'wb') as image_file:
-                            image_file.write(response.content)
-                        # print(f'Saved image for ballot box {ballot_box_number} in local folder')
-                    else:
-                        # print(f'Error downloading image for ballot box {ballot_box_number}')
-                        continue
-
-            # Check if AWS Textract data already exists before sending to AWS
-            textract_data_path = f'textract/{ballot_box_number}/textract_data_cm.json'
-
-            # Check if Textract data exists locally
-            if os.path.exists(textract_data_path):
-                # Load the Textract data from the local file
-                with open(textract_data_path, 'r') as textract_file:
-                    response = json.load(textract_file)
-            else:
-                # Call AWS Textract to process the image
-                with open(local_image_path, 'rb') as image_file:
-                    image_data = image_file.read()
 
-                response = textract_client.analyze_document(
-                    Document={'Bytes': image_data},
-                    FeatureTypes=[
-                        'TABLES',
-                    ])
+            local_image_path = local_image(image_store, image_session, image_url, ballot_box_number)
+            if local_image_path is None:
+                continue
+
+            ballot_boxes.append((school_id, ballot_box_number, local_image_path))
+
+    return ballot_boxes
 
-                # Save the Textract response as JSON
-                os.makedirs(os.path.dirname(textract_data_path), exist_ok=True)
-                with open(textract_data_path, 'w') as textract_file:
-                    json.dump(response, textract_file)
 
-            csv = textract_to_csv(response)
+def local_image(image_store, image_session, image_url, ballot_box_number):
+    # Images are read from the content-addressed store filled by images.py,
+    # anything it has not fetched yet is downloaded here
+    local_image_path = image_store.path_for_url(image_url)
+    if local_image_path is None and image_session is None:
+        # Offline, fall back to the images/{box}/cm.jpg saved by the textract.py before the store
+        return legacy_image(image_store, ballot_box_number)
+    if local_image_path is None:
+        status, digest, size, new = download(image_session, image_store, image_url)
+        if digest is None:
+            METRICS.inc('textract_skipped_total', reason='download_failed')
+            return None
+        local_image_path = image_store.path(digest)
+    return local_image_path
 
-            textract_table_path = f'textract/{ballot_box_number}/textract_table_cm.csv'
-            with open(textract_table_path, 'w') as textract_table_file:
-                textract_table_file.write(csv)
 
-            textract_results = get_vote_count_from_textract(csv)
+@functools.lru_cache(maxsize=None)
+def unique_ballot_box_numbers():
+    # The ballot box numbers that occur in a single school, read once per run
+    schools = {}
+    for filename in os.listdir('ballot_boxes_in_school'):
+        with open(f'ballot_boxes_in_school/{filename}') as file:
+            for ballot_box in json.load(file):
+                schools.setdefault(ballot_box.get('ballot_box_number'), set()).add(filename)
+    return frozenset(number for number, filenames in schools.items() if len(filenames) == 1)
+
+
+def legacy_image(image_store, ballot_box_number):
+    # The legacy layout is keyed by ballot box number only, its image is only used when no other school
+    # has a ballot box with that number. It is copied into the store, which names it by its hash.
+    if ballot_box_number in unique_ballot_box_numbers():
+        for legacy_image_path in (f'images/{ballot_box_number}/cm.jpg', f'not_same/{ballot_box_number}/cm.jpg'):
+            if os.path.exists(legacy_image_path):
+                with open(legacy_image_path, 'rb') as image_file:
+                    digest, size, new = image_store.save_stream([image_file.read()])
+                return image_store.path(digest)
+    METRICS.inc('textract_skipped_total', reason='not_stored')
+    return None
+
+
+def queued_ballot_boxes(work_queue, owner, keys, image_store, image_session, limit):
+    # Up to limit of the most valuable ballot boxes queued by scheduler.py, as (school_id, ballot_box_number,
+    # local_image_path) tuples. The queue key of every item pulled is added to keys as soon as it is leased.
+    ballot_boxes = []
+    while len(keys) < limit:
+        item = work_queue.pop(OCR, owner)
+        if item is None:
+            break
+        key, payload = item
+        keys.append(key)
+        local_image_path = local_image(image_store, image_session, payload['image_url'],
+                                       payload['ballot_box_number'])
+        if local_image_path is not None:
+            ballot_boxes.append((payload['school_id'], payload['ballot_box_number'], local_image_path))
+    return ballot_boxes
+
+
+def stored_digest(local_image_path):
+    # Images in the store are named by the SHA-256 of their bytes
+    return os.path.splitext(os.path.basename(local_image_path))[0]
+
+
+def get_vision_table_data(vision_response):
+    # Process and extract table data
+    table_data = []
+    vision_document = vision_response.get('full_text_annotation') or {}
+    for page in vision_document.get('pages', []):
+        for block in page.get('blocks', []):
+            for paragraph in block.get('paragraphs', []):
+                row_data = []
+                for word in paragraph.get('words', []):
+                    word_text = ''.join([symbol.get('text', '') for symbol in word.get('symbols', [])])
+                    row_data.append(word_text)
+                table_data.append(row_data)
+    return table_data
+
+
+def progress():
+    outcomes = METRICS.by_label('textract_ballot_boxes_total', 'outcome')
+    ocr_calls = METRICS.by_label('ocr_calls_total', 'provider')
+    return (f'{METRICS.total("textract_school_files_total")} school files, '
+            f'{sum(METRICS.by_label("textract_skipped_total", "reason").values())} ballot boxes skipped, '
+            f'OCR calls {dict(ocr_calls) or "none"}, {outcomes["consistent"]} ballot boxes add up, '
+            f'{outcomes["inconsistent"]} do not, {outcomes["no_table"]} without a table')
+
 
-            total_votes = sum(
-                [value for key, value in textract_results.items() if key != "TOPLAM"])
+def main():
+    parser = argparse.ArgumentParser(description='OCR the cm tutanak images and check the vote counts.')
+    parser.add_argument('--provider', choices=('textract', 'fake'), default='textract',
+                        help='fake replays the saved textract_data_cm.json responses without network')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--processes', action='store_true', help='Use a process pool instead of threads')
+    parser.add_argument('--tps', type=float, help="Override the provider's requests per second quota")
+    parser.add_argument('--preprocess', choices=sorted(VARIANTS),
+                        help='Send deskewed and cropped images of this variant instead of the originals')
+    parser.add_argument('--from-queue', nargs='?', const=QUEUE_FILENAME, metavar='QUEUE',
+                        help='OCR the ballot boxes queued by scheduler.py, the most valuable first')
+    parser.add_argument('--batch-size', type=int, default=100, help='Ballot boxes pulled from the queue at a time')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with instrumented(args, progress):
+        run(args)
+
+
+def run(args):
+    # Create directories for images and Textract data
+    os.makedirs('images', exist_ok=True)
+    os.makedirs('textract', exist_ok=True)
+    os.makedirs('not_same', exist_ok=True)
 
-            if total_votes == textract_results["TOPLAM"]:
-                print("All candidates' vote count and the total are the same.")
+    # The providers are created once and their clients reused by every worker
+    if args.provider == 'fake':
+        provider_factory = functools.partial(FakeProvider.from_saved, '.')
+        provider = FakeProvider
+    else:
+        provider_factory = TextractProvider
+        provider = TextractProvider
+    if not args.processes:
+        provider = provider_factory()
+    stats = OcrStats()
+
+    # The fake provider runs offline, images missing from the store are never downloaded
+    image_store = ImageStore()
+    image_session = None if args.provider == 'fake' else create_session(1)
+
+    # Responses are cached under the hash of the image, which names its file in the store, so a sheet
+    # shared by several ballot boxes or seen again in a later run is only sent once
+    ocr_cache = OcrCache()
+    # The responses saved by textract.py before the cache are imported once, with the images they were
+    # saved next to. Newer runs write under textract/{school_id}/ and never touch those files.
+    imported = ocr_cache.import_saved_once('.')
+    if imported is not None:
+        print(f'Imported {imported} saved Textract responses into the OCR cache')
+    features = provider.features
+    if args.preprocess:
+        # The preprocessing variant changes the pixels sent, so it is part of the feature set
+        features = f'{features}+{args.preprocess}'
+
+    if args.from_queue:
+        # Work through the queue in batches, so the most valuable results are saved while the rest waits.
+        # Failed items are completed too, the scheduler queues them again while they have no response.
+        # A batch can take longer than the lease, its leases are extended until it is saved.
+        work_queue = WorkQueue(args.from_queue)
+        owner = default_owner()
+        while True:
+            keys = []
+            with keep_leased(work_queue, OCR, keys, owner):
+                ballot_boxes = queued_ballot_boxes(work_queue, owner, keys, image_store, image_session,
+                                                   args.batch_size)
+                if keys:
+                    process_ballot_boxes(args, ballot_boxes, provider, provider_factory, features, image_store,
+                                         ocr_cache, stats)
+            if not keys:
+                break
+            for key in keys:
+                work_queue.complete(OCR, key, owner)
+        work_queue.close()
+    else:
+        ballot_boxes = collect_ballot_boxes(image_store, image_session)
+        process_ballot_boxes(args, ballot_boxes, provider, provider_factory, features, image_store,
+                             ocr_cache, stats)
+
+    ocr_cache.close()
+    stats.report()
+
+
+def process_ballot_boxes(args, ballot_boxes, provider, provider_factory, features, image_store, ocr_cache, stats):
+    image_digests = {local_image_path: stored_digest(local_image_path) for _, _, local_image_path in ballot_boxes}
+
+    # Send the images without a cached response through the OCR pool
+    jobs = {}
+    for local_image_path, digest in image_digests.items():
+        if digest not in jobs and not os.path.exists(ocr_cache.path(digest, provider.name, features)):
+            jobs[digest] = local_image_path
+    if args.preprocess and jobs:
+        preprocessed_paths = preprocess_store(image_store.root, list(jobs), args.preprocess, args.workers)
+        jobs = {digest: preprocessed_paths[digest] for digest in jobs if digest in preprocessed_paths}
+    for digest, response, error in run_ocr(jobs.items(), provider, args.workers, args.processes,
+                                           provider_factory, args.tps, stats):
+        if error is not None:
+            print(f'Error analyzing image {digest}: {error}')
+            continue
+        ocr_cache.put(digest, provider.name, features, response)
+
+    not_same = []
+    for school_id, ballot_box_number, local_image_path in ballot_boxes:
+        response = ocr_cache.get(image_digests[local_image_path], provider.name, features)
+        if response is None:
+            continue
+
+        # Save the Textract response as JSON next to its table, for reading one ballot box by hand
+        textract_data_path = f'textract/{school_id}/{ballot_box_number}/textract_data_cm.json'
+        os.makedirs(os.path.dirname(textract_data_path), exist_ok=True)
+        with open(textract_data_path, 'w') as textract_file:
+            json.dump(response, textract_file)
+
+        parse_started_at = time.monotonic()
+        tables = extract_tables(response)
+        if not tables:
+            METRICS.inc('textract_ballot_boxes_total', outcome='no_table')
+
+        textract_table_path = f'textract/{school_id}/{ballot_box_number}/textract_table_cm.csv'
+        with open(textract_table_path, 'w') as textract_table_file:
+            textract_table_file.write(tables_to_csv(tables))
+
+        textract_results = get_vote_counts(tables)
+        METRICS.observe('textract_parse_duration_seconds', time.monotonic() - parse_started_at)
+
+        total_votes = sum(
+            [value for key, value in textract_results.items() if key != TOTAL])
+
+        if total_votes == textract_results.get(TOTAL):
+            METRICS.inc('textract_ballot_boxes_total', outcome='consistent')
+        else:
+            METRICS.inc('textract_ballot_boxes_total', outcome='inconsistent')
+            METRICS.trace('inconsistent', school_id=school_id, ballot_box_number=ballot_box_number,
+                          image=local_image_path, votes=textract_results)
+            not_same.append((school_id, ballot_box_number, local_image_path))
+    print(f'{len(not_same)} ballot boxes where the candidates do not add up to the total')
+
+    # Run the mismatches through Google Vision with a single client, cached like the Textract responses
+    if not_same and args.provider == 'fake':
+        print(f'Skipping the Vision fallback for {len(not_same)} ballot boxes with the fake provider')
+    elif not_same:
+        vision_responses = {}
+        vision_jobs = {}
+        for school_id, ballot_box_number, local_image_path in not_same:
+            digest = image_digests[local_image_path]
+            vision_response = ocr_cache.get(digest, VisionProvider.name, VisionProvider.features)
+            if vision_response is not None:
+                vision_responses[digest] = vision_response
             else:
-                print("#################All candidates' vote count and the total are not the same.")
-                vision_client = vision.ImageAnnotatorClient()
-                
-                with open(local_image_path, 'rb') as image_file:
-                    image_data = image_file.read()
-                image = vision.Image(content=image_data)
-                vision_data_path = f'textract/{ballot_box_number}/vision_data_cm.json'
-                vision_response = vision_client.document_text_detection(image=image)
-                vision_document = vision_response.full_text_annotation
-                
-                # os.makedirs(os.path.dirname(vision_data_path), exist_ok=True)
-                # with open(vision_data_path, 'w') as vision_file:
-                #     json.dump(vision_document, vision_file)
-
-                # Process and extract table data
-                table_data = []
-                for page in vision_document.pages:
-                    for block in page.blocks:
-                        for paragraph in block.paragraphs:
-                            print(paragraph)
-                            row_data = []
-                            for word in paragraph.words:
-                                word_text = ''.join([symbol.text for symbol in word.symbols])
-                                row_data.append(word_text)
-                            table_data.append(row_data)
-                print(table_data)
-                # Move the Textract data and image to not_same folder
-                not_same_textract_path = f'not_same/{ballot_box_number}/textract_data_cm.json'
-                not_same_textract_table_path = f'not_same/{ballot_box_number}/textract_data_table_cm.csv'
-                not_same_image_path = f'not_same/{ballot_box_number}/cm.jpg'
-                os.makedirs(os.path.dirname(
-                    not_same_textract_path), exist_ok=True)
-                os.makedirs(os.path.dirname(
-                    not_same_textract_table_path), exist_ok=True)
-                os.makedirs(os.path.dirname(
-                    not_same_image_path), exist_ok=True)
-
-                os.rename(textract_data_path, not_same_textract_path)
-                os.rename(textract_table_path, not_same_textract_table_path)
-                os.rename(local_image_path, not_same_image_path)
-
-            # print(f'Saved AWS Textract data for ballot box {ballot_box_number}')
-
-            print('\n\n\n')
+                vision_jobs[digest] = local_image_path
+
+        if vision_jobs:
+            vision_provider = VisionProvider()
+            for digest, vision_response, error in run_ocr(vision_jobs.items(), vision_provider, args.workers,
+                                                          stats=stats):
+                if error is not None:
+                    print(f'Error analyzing image {digest} with Vision: {error}')
+                    continue
+                ocr_cache.put(digest, vision_provider.name, vision_provider.features, vision_response)
+                vision_responses[digest] = vision_response
+
+        for school_id, ballot_box_number, local_image_path in not_same:
+            vision_response = vision_responses.get(image_digests[local_image_path])
+            if vision_response is None:
+                continue
+
+            box_dir = f'{school_id}/{ballot_box_number}'
+            vision_data_path = f'textract/{box_dir}/vision_data_cm.json'
+            with open(vision_data_path, 'w') as vision_file:
+                json.dump(vision_response, vision_file)
+
+            table_data = get_vision_table_data(vision_response)
+            print(table_data)
+
+            # Move the Textract data and image to not_same folder, the responses stay in the cache
+            # Each ballot box has its own directory, so the files moved are never another ballot box's
+            textract_data_path = f'textract/{box_dir}/textract_data_cm.json'
+            textract_table_path = f'textract/{box_dir}/textract_table_cm.csv'
+            not_same_textract_path = f'not_same/{box_dir}/textract_data_cm.json'
+            not_same_textract_table_path = f'not_same/{box_dir}/textract_data_table_cm.csv'
+            not_same_image_path = f'not_same/{box_dir}/cm.jpg'
+            os.makedirs(os.path.dirname(
+                not_same_textract_path), exist_ok=True)
+
+            os.replace(textract_data_path, not_same_textract_path)
+            os.replace(textract_table_path, not_same_textract_table_path)
+            # The image stays in the store, other ballot boxes may share it
+            shutil.copyfile(local_image_path, not_same_image_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+from collections import namedtuple
+from operator import attrgetter
+
+# A table cell with its 1-based position and the text of its words, and a table as rows of cells
+Cell = namedtuple('Cell', ['row', 'column', 'text'])
+Table = namedtuple('Table', ['index', 'rows'])
+
+
+class Normalizer(dict):
+    # str.translate table built lazily: Turkish letters are folded to their upper-case ASCII base
+    # letter, other letters upper-cased, whitespace kept and anything else dropped
+    TRANSLITERATION = {'İ': 'I', 'ı': 'I', 'Ç': 'C', 'ç': 'C', 'Ğ': 'G', 'ğ': 'G',
+                       'Ö': 'O', 'ö': 'O', 'Ş': 'S', 'ş': 'S', 'Ü': 'U', 'ü': 'U'}
+    ALLOWED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+    def __missing__(self, code):
+        character = chr(code)
+        character = self.TRANSLITERATION.get(character, character.upper())
+        if character.isspace():
+            value = ' '
+        elif character in self.ALLOWED:
+            value = character
+        else:
+            value = None
+        self[code] = value
+        return value
+
+
+NORMALIZER = Normalizer()
+
+
+def normalize_text(text):
+    # OCR output is matched in plain upper-case ASCII with single spaces
+    return ' '.join(text.translate(NORMALIZER).split())
+
+
+def child_ids(block):
+    ids = []
+    for relationship in block.get('Relationships', ()):
+        if relationship['Type'] == 'CHILD':
+            ids.extend(relationship['Ids'])
+    return ids
+
+
+def cell_text(cell, blocks_map):
+    words = []
+    for child_id in child_ids(cell):
+        child = blocks_map[child_id]
+        block_type = child['BlockType']
+        if block_type == 'WORD':
+            words.append(child['Text'])
+        elif block_type == 'SELECTION_ELEMENT' and child['SelectionStatus'] == 'SELECTED':
+            words.append('X')
+    return ' '.join(words)
+
+
+def extract_tables(response):
+    # Index the blocks once, then read each table's cells straight from its CHILD relationships
+    blocks = response['Blocks']
+    blocks_map = {block['Id']: block for block in blocks}
+
+    tables = []
+    for block in blocks:
+        if block['BlockType'] != 'TABLE':
+            continue
+
+        rows = {}
+        for child_id in child_ids(block):
+            cell = blocks_map[child_id]
+            if cell['BlockType'] == 'CELL':
+                row_index = cell['RowIndex']
+                row = rows.get(row_index)
+                if row is None:
+                    row = rows[row_index] = []
+                row.append(Cell(row_index, cell['ColumnIndex'], cell_text(cell, blocks_map)))
+
+        table_rows = []
+        for row_index in sorted(rows):
+            row = rows[row_index]
+            row.sort(key=attrgetter('column'))
+            table_rows.append(row)
+        tables.append(Table(len(tables) + 1, table_rows))
+    return tables
+
+
+def tables_to_csv(tables):
+    # One line per row with the cells in the same cleaned form used for matching
+    lines = []
+    for table in tables:
+        lines.append(f'Table {table.index}')
+        for row in table.rows:
+            lines.append(','.join(normalize_text(cell.text) for cell in row))
+        lines.append('')
+    return '\n'.join(lines)
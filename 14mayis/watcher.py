@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from aggregate import AGGREGATES_FILENAME, Aggregates
+from compact import RESULT_KINDS
+from crawler import API_BASE, Crawler
+from files import read_json, write_text
+from images import ImageStore, create_session, download
+from metrics import METRICS, add_arguments, instrumented
+from rate_limiter import API_LIMITER
+from scheduler import DISCREPANCY_WEIGHT, FRESH_PRIORITY
+from work_queue import OCR, QUEUE_FILENAME, WorkQueue
+
+FEED_FILENAME = 'changes.jsonl'
+STAGES = ('images', 'ocr', 'aggregate')
+
+# Change events of a ballot box result
+NEW_RESULT = 'new_result'
+VOTES_CHANGED = 'votes_changed'
+NEW_IMAGE = 'new_image'
+
+
+def school_events(school_id, previous_data, data):
+    # The changes between two versions of a school's ballot boxes, per ballot box and result kind
+    previous_boxes = {ballot_box.get('ballot_box_number'): ballot_box for ballot_box in previous_data or []}
+    events = []
+    for ballot_box in data:
+        ballot_box_number = ballot_box.get('ballot_box_number')
+        previous_box = previous_boxes.get(ballot_box_number, {})
+        for kind in RESULT_KINDS:
+            result = ballot_box.get(f'{kind}_result')
+            previous_result = previous_box.get(f'{kind}_result')
+            if not result:
+                continue
+            event = {'school_id': school_id, 'ballot_box_number': ballot_box_number, 'kind': kind,
+                     'image_url': result.get('image_url'), 'total_vote': result.get('total_vote'),
+                     'votes': result.get('votes') or {}}
+            if not previous_result:
+                events.append({'event': NEW_RESULT, **event})
+                continue
+            if (result.get('votes') or {}) != (previous_result.get('votes') or {}) or \
+                    result.get('total_vote') != previous_result.get('total_vote'):
+                events.append({'event': VOTES_CHANGED, **event, 'previous_total_vote': previous_result.get('total_vote'),
+                               'previous_votes': previous_result.get('votes') or {}})
+            if result.get('image_url') and result.get('image_url') != previous_result.get('image_url'):
+                events.append({'event': NEW_IMAGE, **event})
+    return events
+
+
+def last_seq(filename):
+    # The number of the last event in the feed, read from its end
+    if not os.path.exists(filename):
+        return 0
+    with open(filename, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        file.seek(max(file.tell() - 64 * 1024, 0))
+        lines = [line for line in file.read().split(b'\n') if line.strip()]
+    return json.loads(lines[-1])['seq'] if lines else 0
+
+
+class ChangeFeed:
+    # Append-only JSONL of change events, numbered in order. Every batch is flushed to disk before the
+    # school file is replaced, so no change is lost to a crash. An interrupted change is reported again
+    # by the next round, every stage has to handle an event twice.
+    def __init__(self, filename=FEED_FILENAME):
+        self.filename = filename
+        self.seq = last_seq(filename)
+        self.file = open(filename, 'a')
+
+    def append(self, events):
+        for event in events:
+            self.seq += 1
+            self.file.write(json.dumps({'seq': self.seq, 'ts': round(time.time(), 6), **event}) + '\n')
+            METRICS.inc('watcher_events_total', event=event['event'], kind=event['kind'])
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+def reflects(ballot_boxes_in_school_data, events):
+    # Whether a school's file already holds the results its events report
+    ballot_boxes = {ballot_box.get('ballot_box_number'): ballot_box for ballot_box in ballot_boxes_in_school_data}
+    for event in events:
+        result = ballot_boxes.get(event['ballot_box_number'], {}).get(f'{event["kind"]}_result') or {}
+        if (result.get('votes') or {}) != event['votes'] or result.get('total_vote') != event['total_vote']:
+            return False
+    return True
+
+
+def read_events(filename, offset):
+    # The complete lines after offset, and the offset after them
+    if not os.path.exists(filename):
+        return [], offset
+    with open(filename, 'rb') as file:
+        file.seek(offset)
+        data = file.read()
+    # A line the watcher is still writing is left for the next read
+    data = data[:data.rfind(b'\n') + 1]
+    events = [json.loads(line) for line in data.splitlines() if line.strip()]
+    return events, offset + len(data)
+
+
+def offset_filename(feed_filename, stage):
+    return f'{feed_filename}.{stage}.offset'
+
+
+def read_offset(filename):
+    if not os.path.exists(filename):
+        return 0
+    with open(filename) as file:
+        return int(file.read() or 0)
+
+
+def write_offset(filename, offset):
+    write_text(filename, str(offset))
+
+
+def watch(args):
+    # Poll the schools again and again, every change found by a refresh becomes events in the feed
+    feed = ChangeFeed(args.feed)
+    API_LIMITER.set_rate(args.rate)
+    API_LIMITER.max_rate = args.max_rate
+
+    def on_change(task, task_args, previous_data, data):
+        if task == 'crawl_school':
+            feed.append(school_events(task_args[0], previous_data, data))
+
+    crawlers = []
+
+    def progress():
+        events = METRICS.by_label('watcher_events_total', 'event')
+        line = crawlers[-1].progress() if crawlers else 'Starting'
+        return f'{line}, feed at {feed.seq}, {dict(events) or "no events"} this run'
+
+    try:
+        with instrumented(args, progress):
+            while True:
+                crawler = Crawler(levels=['ballot_boxes'], concurrency=args.concurrency, base_url=args.base_url,
+                                  root=args.root, on_change=on_change)
+                crawlers[:] = [crawler]
+                asyncio.run(crawler.run(refresh=True, everything=args.refresh_all))
+                if not args.interval:
+                    break
+                time.sleep(args.interval)
+    finally:
+        feed.close()
+
+
+class ImagesStage:
+    # Download the new tutanak images into the store, so OCR does not have to
+    def __init__(self, args):
+        self.store = ImageStore()
+        self.session = create_session(1)
+
+    def handle(self, events):
+        for event in events:
+            if event['event'] in (NEW_RESULT, NEW_IMAGE) and event['kind'] == 'cm' and event['image_url'] \
+                    and self.store.lookup(event['image_url']) is None:
+                status, digest, size, new = download(self.session, self.store, event['image_url'])
+                METRICS.inc('watcher_consumed_total', stage='images', outcome='saved' if digest else 'failed')
+
+    def close(self):
+        self.store.close()
+
+
+class OcrStage:
+    # Queue the new cm images for textract.py --from-queue ahead of the planned work
+    def __init__(self, args):
+        self.queue = WorkQueue(args.queue)
+
+    def handle(self, events):
+        items = {}
+        for event in events:
+            if event['event'] not in (NEW_RESULT, NEW_IMAGE) or event['kind'] != 'cm' or not event['image_url']:
+                continue
+            discrepancy = sum(event['votes'].values()) != (event['total_vote'] or 0)
+            items[event['image_url']] = (event['image_url'], FRESH_PRIORITY + DISCREPANCY_WEIGHT * discrepancy,
+                                         {'school_id': event['school_id'],
+                                          'ballot_box_number': event['ballot_box_number'],
+                                          'image_url': event['image_url']})
+        if items:
+            self.queue.push(OCR, list(items.values()))
+            METRICS.inc('watcher_consumed_total', len(items), stage='ocr', outcome='queued')
+
+    def close(self):
+        self.queue.close()
+
+
+class AggregateStage:
+    # Apply the changed schools to the saved aggregates, each one only touches its path to the city
+    def __init__(self, args):
+        self.root = args.root
+        self.filename = args.aggregates
+        if os.path.exists(self.filename):
+            self.aggregates = Aggregates.load(self.filename)
+        else:
+            self.aggregates = Aggregates.build(self.root)
+
+    def handle(self, events):
+        events_by_school = {}
+        for event in events:
+            events_by_school.setdefault(event['school_id'], []).append(event)
+        changed = 0
+        for school_id, events_of_school in events_by_school.items():
+            filename = os.path.join(self.root, 'ballot_boxes_in_school', f'{school_id}.json')
+            if school_id in self.aggregates.rows['school'] and os.path.exists(filename):
+                changed += self.aggregates.update_school(school_id, self.read_school(filename, events_of_school))
+        if changed:
+            self.aggregates.save(self.filename)
+        METRICS.inc('watcher_consumed_total', changed, stage='aggregate', outcome='updated')
+
+    def read_school(self, filename, events):
+        # The watcher appends the events just before it replaces the file, give it a moment to catch up.
+        # A file that never matches them changed again since, its newer events follow in the feed.
+        for attempt in range(10):
+            data = read_json(filename)
+            if reflects(data, events):
+                break
+            time.sleep(0.1)
+        return data
+
+    def close(self):
+        pass
+
+
+def consume(args):
+    # Follow the feed from where this stage stopped, its offset is saved after every batch
+    stage = {'images': ImagesStage, 'ocr': OcrStage, 'aggregate': AggregateStage}[args.stage](args)
+    offset_file = offset_filename(args.feed, args.stage)
+    offset = read_offset(offset_file)
+    consumed = 0
+    try:
+        while True:
+            events, new_offset = read_events(args.feed, offset)
+            if events:
+                stage.handle(events)
+                write_offset(offset_file, new_offset)
+                consumed += len(events)
+                print(f'{args.stage}: {len(events)} events up to {events[-1]["seq"]}, {consumed} this run')
+            offset = new_offset
+            if not events and args.once:
+                break
+            if not events:
+                time.sleep(args.poll_interval)
+    finally:
+        stage.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Watch the schools for new tutanak submissions and stream the changes to the later stages.')
+    parser.add_argument('command', choices=('watch', 'consume'))
+    parser.add_argument('--feed', default=FEED_FILENAME, help='Append-only JSONL of change events')
+    parser.add_argument('--root', default='.', help='Directory holding the scraped JSON tree')
+    # watch
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help='Seconds between polling rounds, 0 polls once')
+    parser.add_argument('--refresh-all', action='store_true',
+                        help='Poll every fetched school, not only those with results still missing')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rate', type=float, default=API_LIMITER.rate)
+    parser.add_argument('--max-rate', type=float, default=API_LIMITER.max_rate)
+    parser.add_argument('--base-url', default=API_BASE)
+    # consume
+    parser.add_argument('--stage', choices=STAGES, help='The stage fed by consume')
+    parser.add_argument('--once', action='store_true', help='Stop once the stage caught up with the feed')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between reads of the feed')
+    parser.add_argument('--queue', default=QUEUE_FILENAME, help='Work queue the ocr stage pushes to')
+    parser.add_argument('--aggregates', default=AGGREGATES_FILENAME, help='Aggregates the aggregate stage updates')
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.rate > args.max_rate:
+        parser.error('--rate cannot be above --max-rate, the limiter would clamp it')
+
+    if args.command == 'watch':
+        watch(args)
+    elif args.stage is None:
+        parser.error('consume needs --stage')
+    else:
+        consume(args)
+
+
+if __name__ == "__main__":
+    main()
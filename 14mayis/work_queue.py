@@ -0,0 +1,177 @@
+import asyncio
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+QUEUE_FILENAME = 'work_queue.sqlite'
+
+# Work kinds: a school's ballot boxes to fetch, a ballot box's cm image to OCR, a flagged ballot box to review
+FETCH = 'fetch'
+OCR = 'ocr'
+REVIEW = 'review'
+
+# Item statuses, a leased item whose lease ran out is pending again
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS work (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    priority REAL NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    leased_until REAL,
+    owner TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS work_next ON work (kind, status, priority DESC);
+"""
+
+
+class WorkQueue:
+    # A priority queue of fetch and OCR work shared by every process through one SQLite file.
+    # pop() always leases the most valuable pending item, workers that die lose their lease.
+    # WAL keeps readers and the writer out of each other's way, but needs every process on one host.
+    # A queue shared over a network filesystem uses journal_mode='DELETE' instead.
+    def __init__(self, filename=QUEUE_FILENAME, lease_seconds=300, journal_mode='WAL'):
+        self.filename = filename
+        self.lease_seconds = lease_seconds
+        self.journal_mode = journal_mode
+        self.connection = sqlite3.connect(filename, timeout=30, isolation_level=None)
+        self.connection.execute(f'PRAGMA journal_mode={journal_mode}')
+        self.connection.executescript(SCHEMA)
+
+    def push(self, kind, items, keep_above=None):
+        # items are (key, priority, payload) tuples. Pending items take the new priority, done items
+        # are queued again, as the planner only pushes work that is still needed. Items not done yet
+        # whose priority is at least keep_above keep it, so a planner does not demote urgent work.
+        now = time.time()
+        # The connection is in autocommit mode for pop(), the whole batch is one explicit transaction
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.executemany(
+                'INSERT INTO work (kind, key, priority, payload, updated_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (kind, key) DO UPDATE SET '
+                'priority = CASE WHEN status != ? AND priority >= ? THEN priority ELSE excluded.priority END, '
+                'payload = excluded.payload, status = CASE WHEN status = ? THEN ? ELSE status END, '
+                'updated_at = excluded.updated_at',
+                [(kind, key, priority, json.dumps(payload), now, DONE, keep_above, DONE, PENDING)
+                 for key, priority, payload in items])
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def pop(self, kind, owner=None):
+        # Lease the highest priority item in one statement, so concurrent workers never get the same one.
+        # Pending items and expired leases are looked up separately, so each side walks the index.
+        now = time.time()
+        row = self.connection.execute(
+            'UPDATE work SET status = ?, leased_until = ?, owner = ?, attempts = attempts + 1, updated_at = ? '
+            'WHERE rowid = (SELECT rowid FROM ('
+            'SELECT * FROM (SELECT rowid, priority FROM work WHERE kind = ? AND status = ? '
+            'ORDER BY priority DESC LIMIT 1) UNION ALL '
+            'SELECT * FROM (SELECT rowid, priority FROM work WHERE kind = ? AND status = ? AND leased_until < ? '
+            'ORDER BY priority DESC LIMIT 1)) ORDER BY priority DESC LIMIT 1) '
+            'RETURNING key, payload',
+            (LEASED, now + self.lease_seconds, owner, now, kind, PENDING, kind, LEASED, now)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def extend(self, kind, key, owner=None):
+        # Heartbeat of a long running item, False when the lease ran out and another worker took it
+        now = time.time()
+        return self.connection.execute(
+            'UPDATE work SET leased_until = ?, updated_at = ? WHERE kind = ? AND key = ? AND status = ? '
+            'AND owner IS ?', (now + self.lease_seconds, now, kind, key, LEASED, owner)).rowcount == 1
+
+    def complete(self, kind, key, owner=None):
+        # Only the worker holding the lease completes an item, False when it ran out and was taken over
+        return self.connection.execute(
+            'UPDATE work SET status = ?, leased_until = NULL, updated_at = ? WHERE kind = ? AND key = ? '
+            'AND status = ? AND owner IS ?', (DONE, time.time(), kind, key, LEASED, owner)).rowcount == 1
+
+    def release(self, kind, key, owner=None):
+        # Give a leased item back, e.g. when the worker is stopped before it got to it
+        return self.connection.execute(
+            'UPDATE work SET status = ?, leased_until = NULL, updated_at = ? WHERE kind = ? AND key = ? '
+            'AND status = ? AND owner IS ?', (PENDING, time.time(), kind, key, LEASED, owner)).rowcount == 1
+
+    def retire(self, kind, before):
+        # Pending items the planner did not push again since before are no longer needed
+        return self.connection.execute('UPDATE work SET status = ?, updated_at = ? '
+                                       'WHERE kind = ? AND status = ? AND updated_at < ?',
+                                       (DONE, time.time(), kind, PENDING, before)).rowcount
+
+    def keys(self, kind, status):
+        return {key for key, in self.connection.execute('SELECT key FROM work WHERE kind = ? AND status = ?',
+                                                        (kind, status))}
+
+    def leases(self, kind):
+        # (owner, key, leased_until) of the items being worked on, including expired leases
+        return self.connection.execute('SELECT owner, key, leased_until FROM work WHERE kind = ? AND status = ? '
+                                       'ORDER BY owner, key', (kind, LEASED)).fetchall()
+
+    def counts(self):
+        return self.connection.execute(
+            'SELECT kind, status, COUNT(*), MAX(priority) FROM work GROUP BY kind, status ORDER BY kind, status'
+        ).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+
+def default_owner():
+    # Leases are recorded per process, workers within a process add their own suffix
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+async def heartbeat(queue, kind, key, owner):
+    # Keep the lease of an item while it is worked on, returns once it is lost to another worker
+    while True:
+        await asyncio.sleep(queue.lease_seconds / 3)
+        try:
+            extended = queue.extend(kind, key, owner)
+        except sqlite3.OperationalError as error:
+            # A busy or unreachable queue, tried again on the next beat before the lease runs out
+            print(f'Could not extend the lease of {kind} {key}: {error}')
+            continue
+        if not extended:
+            print(f'Lost the lease of {kind} {key}, another worker may work on it too')
+            return
+
+
+@contextlib.contextmanager
+def keep_leased(queue, kind, keys, owner):
+    # The synchronous counterpart of heartbeat for a batch of items, extended from a thread
+    # with its own connection as SQLite connections stay in the thread that opened them
+    stop = threading.Event()
+
+    def extend():
+        thread_queue = WorkQueue(queue.filename, queue.lease_seconds, queue.journal_mode)
+        try:
+            while not stop.wait(queue.lease_seconds / 3):
+                for key in list(keys):
+                    try:
+                        thread_queue.extend(kind, key, owner)
+                    except sqlite3.OperationalError as error:
+                        print(f'Could not extend the lease of {kind} {key}: {error}')
+        finally:
+            thread_queue.close()
+
+    thread = threading.Thread(target=extend, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()